@@ -0,0 +1,290 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Follow the HLS playlists written by MediaLive and send new segments for inference.
+
+This is an alternative to the per-object S3 trigger (one Lambda invocation and
+one endpoint call per .ts segment). One thread follows the .m3u8 playlist of
+each channel, picks up the segments that appeared since the last poll in
+media sequence order, and sends them in batches (S3_VIDEO_PATHS) to either
+
+* the SageMaker endpoint (--endpoint-name), or
+* the inference code loaded in-process (--model-dir), which together with a
+  local playlist or a plain directory of .ts files makes it easy to test the
+  production inference path without any AWS resources.
+
+Segments of a channel are always submitted in order, so the per-stream
+smoothing of the endpoint sees them in sequence. A live channel is followed from
+the segment after the newest one in the playlist when the follower starts;
+--backfill (implied by --once) also submits the segments already listed, and
+the whole playlist is always read once it has ended.
+
+Examples:
+    python hls_ingest.py --playlist s3://<bucket>/livestream_pipe/channel_1.m3u8 \\
+        --endpoint-name activity-detection-endpoint --table-name activity-detection-table
+    python hls_ingest.py --playlist ./segments --model-dir ../model --once
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import posixpath
+import sys
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+
+def parse_playlist(text):
+    """Parse an HLS playlist.
+
+    Returns a dict with the target duration, whether the playlist has ended, the
+    variant playlists of a master playlist and the (media sequence, uri) of the
+    media segments.
+    """
+    playlist = {'target_duration': 10.0, 'ended': False, 'variants': [], 'segments': []}
+    sequence = 0
+    expect_variant = False
+    in_segment = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            playlist['target_duration'] = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-ENDLIST'):
+            playlist['ended'] = True
+        elif line.startswith('#EXT-X-STREAM-INF'):
+            expect_variant = True
+        elif line.startswith('#EXTINF'):
+            in_segment = True
+        elif not line.startswith('#'):
+            if expect_variant:
+                playlist['variants'].append(line)
+                expect_variant = False
+            elif in_segment:
+                playlist['segments'].append((sequence, line))
+                sequence += 1
+                in_segment = False
+    return playlist
+
+
+class S3PlaylistSource(object):
+    """Playlist and segments stored in S3, read with a pooled client."""
+    def __init__(self, playlist_path, s3_client):
+        self.bucket, self.key = playlist_path.replace('s3://', '').replace('S3://', '').split('/', 1)
+        self.s3_client = s3_client
+        self.name = posixpath.splitext(posixpath.basename(self.key))[0]
+
+    def read(self):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        return response['Body'].read().decode('utf-8')
+
+    def resolve(self, uri):
+        if uri.startswith('s3://') or uri.startswith('S3://'):
+            return uri
+        return 's3://{}/{}'.format(self.bucket, posixpath.normpath(posixpath.join(posixpath.dirname(self.key), uri)))
+
+    def follow(self, uri):
+        return S3PlaylistSource(self.resolve(uri), self.s3_client)
+
+
+class LocalPlaylistSource(object):
+    """A local .m3u8 playlist, or a directory whose sorted .ts files act as one."""
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = os.path.splitext(os.path.basename(self.path.rstrip('/')))[0]
+
+    def read(self):
+        if os.path.isdir(self.path):
+            segments = sorted(glob.glob(os.path.join(self.path, '*.ts')))
+            lines = ['#EXTM3U', '#EXT-X-MEDIA-SEQUENCE:0']
+            for segment in segments:
+                lines += ['#EXTINF:10.0,', os.path.basename(segment)]
+            return '\n'.join(lines)
+        with open(self.path, 'r') as fopen:
+            return fopen.read()
+
+    def resolve(self, uri):
+        base = self.path if os.path.isdir(self.path) else os.path.dirname(self.path)
+        return os.path.normpath(os.path.join(base, uri))
+
+    def follow(self, uri):
+        return LocalPlaylistSource(self.resolve(uri))
+
+
+class EndpointSink(object):
+    """Send batches of segments to the SageMaker endpoint."""
+    def __init__(self, endpoint_name, runtime_client):
+        self.endpoint_name = endpoint_name
+        self.runtime_client = runtime_client
+
+    def submit(self, payload):
+        response = self.runtime_client.invoke_endpoint(EndpointName=self.endpoint_name,
+                                                       ContentType='application/json',
+                                                       Body=json.dumps(payload))
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+
+class LocalSink(object):
+    """Run the endpoint's inference code in this process."""
+    def __init__(self, model_dir):
+        sys.path.insert(0, os.path.join(model_dir, 'code'))
+        self.inference = importlib.import_module('inference')
+        self.models = self.inference.model_fn(model_dir)
+        #the models are not thread safe, channels take turns
+        self.lock = threading.Lock()
+
+    def submit(self, payload):
+        with self.lock:
+            body, _ = self.inference.transform_fn(self.models, json.dumps(payload),
+                                                  'application/json', 'application/json')
+        return json.loads(body)
+
+
+class ChannelFollower(object):
+    """Poll one channel's playlist and submit its new segments in order."""
+    def __init__(self, source, sink, payload, batch_size=4, poll_interval=None, once=False, backfill=False):
+        self.source = source
+        self.sink = sink
+        self.payload = dict(payload, STREAM_ID=source.name)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.once = once
+        self.backfill = backfill
+        self.next_sequence = None
+        self.stats = {'segments': 0, 'batches': 0, 'skipped': 0, 'failed': 0, 'poll_errors': 0, 'resets': 0,
+                      'seconds': 0.0}
+
+    def _media_playlist(self):
+        playlist = parse_playlist(self.source.read())
+        #a master playlist only lists the renditions, follow the first one
+        if playlist['variants']:
+            self.source = self.source.follow(playlist['variants'][0])
+            playlist = parse_playlist(self.source.read())
+        return playlist
+
+    def poll(self):
+        """Submit the segments added since the last poll. Returns the playlist."""
+        playlist = self._media_playlist()
+        segments = playlist['segments']
+        if self.next_sequence is None and not (self.backfill or playlist['ended']):
+            #start at the live edge, the listed segments were published before we started
+            self.next_sequence = segments[-1][0] + 1 if segments else 0
+            return playlist
+        if segments and self.next_sequence is not None and segments[-1][0] < self.next_sequence - len(segments):
+            #the newest segment is further back than the playlist window, the channel restarted
+            #and its media sequence started over
+            print('[{}] media sequence went back from {} to {}, following the restarted channel'.format(
+                self.source.name, self.next_sequence, segments[-1][0]))
+            self.stats['resets'] += 1
+            self.next_sequence = segments[0][0]
+        if self.next_sequence is not None:
+            if segments and segments[0][0] > self.next_sequence > 0:
+                #segments rotated out of the playlist before we got to them (0 is an empty
+                #first playlist, where the media sequence was not known yet)
+                missed = segments[0][0] - self.next_sequence
+                self.stats['skipped'] += missed
+                print('[{}] {} segments expired before they were read'.format(self.source.name, missed))
+            segments = [s for s in segments if s[0] >= self.next_sequence]
+        for start in range(0, len(segments), self.batch_size):
+            batch = segments[start:start + self.batch_size]
+            payload = dict(self.payload, S3_VIDEO_PATHS=[self.source.resolve(uri) for _, uri in batch])
+            tic = time.time()
+            try:
+                self.sink.submit(payload)
+            except Exception as e:
+                #retried from this batch at the next poll, so the segments stay in order
+                self.stats['failed'] += len(batch)
+                print('[{}] batch {}-{} failed, retrying at the next poll: {}'.format(
+                    self.source.name, batch[0][0], batch[-1][0], e))
+                if self.next_sequence is None:
+                    self.next_sequence = batch[0][0]
+                break
+            finally:
+                self.stats['seconds'] += time.time() - tic
+            self.stats['segments'] += len(batch)
+            self.stats['batches'] += 1
+            self.next_sequence = batch[-1][0] + 1
+        if self.next_sequence is None:
+            self.next_sequence = segments[-1][0] + 1 if segments else 0
+        return playlist
+
+    def run(self):
+        #MediaLive adds a segment every target duration
+        interval = self.poll_interval or 5.0
+        while True:
+            tic = time.time()
+            try:
+                playlist = self.poll()
+            except Exception as e:
+                #a failed read of the playlist is retried at the next poll
+                self.stats['poll_errors'] += 1
+                print('[{}] poll failed: {}'.format(self.source.name, e))
+                if self.once:
+                    break
+            else:
+                if self.once or playlist['ended']:
+                    break
+                interval = self.poll_interval or playlist['target_duration'] / 2.0
+            time.sleep(max(interval - (time.time() - tic), 0))
+        print('[{}] {}'.format(self.source.name, json.dumps(self.stats)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Send new HLS segments to the activity detection model')
+    parser.add_argument('--playlist', type=str, action='append', required=True,
+                        help='.m3u8 playlist (s3:// or local) or a local directory of .ts segments, one per channel')
+    parser.add_argument('--endpoint-name', type=str, default=None, help='SageMaker endpoint to invoke')
+    parser.add_argument('--model-dir', type=str, default=None, help='run the inference code from this model directory locally')
+    parser.add_argument('--table-name', type=str, default=None, help='DynamoDB table for the predictions')
+    parser.add_argument('--max-frames', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=4, help='segments per request')
+    parser.add_argument('--poll-interval', type=float, default=None, help='defaults to half the target duration')
+    parser.add_argument('--max-connections', type=int, default=32, help='size of the boto3 connection pool')
+    parser.add_argument('--once', action='store_true', default=False, help='process the current playlists and exit')
+    parser.add_argument('--backfill', action='store_true', default=False,
+                        help='also submit the segments already in the playlist at start, instead of starting at the live edge')
+    args = parser.parse_args()
+    if bool(args.endpoint_name) == bool(args.model_dir):
+        parser.error('give exactly one of --endpoint-name and --model-dir')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    #one pooled client of each kind is shared by all channel threads
+    config = Config(max_pool_connections=args.max_connections, retries={'max_attempts': 3})
+    if args.endpoint_name:
+        sink = EndpointSink(args.endpoint_name, boto3.client('runtime.sagemaker', config=config))
+    else:
+        sink = LocalSink(args.model_dir)
+    payload = {'MODEL_MAX_FRAMES': args.max_frames, 'DETECTION_TABLE_NAME': args.table_name}
+
+    s3_client = boto3.client('s3', config=config)
+    followers = []
+    for playlist in args.playlist:
+        if playlist.lower().startswith('s3://'):
+            source = S3PlaylistSource(playlist, s3_client)
+        else:
+            source = LocalPlaylistSource(playlist)
+        followers.append(ChannelFollower(source, sink, payload, batch_size=args.batch_size,
+                                         poll_interval=args.poll_interval, once=args.once,
+                                         backfill=args.backfill or args.once))
+
+    threads = [threading.Thread(target=follower.run) for follower in followers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
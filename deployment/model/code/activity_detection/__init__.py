@@ -0,0 +1,16 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Activity detection inference shared by the SageMaker entry points and the local tools.
+
+The endpoint's inference.py (deployment/model/code) and the notebook's
+(development/inference-code) are thin wrappers around this package, so the
+fetch, decode, preprocessing and prediction path is the same everywhere.
+"""
+
+from .models import load_models, load_model, read_classes, select_variant
+from .placement import place_worker
+from .predict import predict_request, predict_segment, score_directory, stream_key, format_prediction
+from .sinks import BatchDynamoDBSink, DynamoDBSink, FileSink, JsonSink, save_to_dynamodb
+from .video import VideoLimitExceeded, get_bucket_and_key, preprocess_frames, read_video_data, read_video_frames, \
+    read_video_windows
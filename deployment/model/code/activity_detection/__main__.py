@@ -0,0 +1,54 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Score a directory of videos with the production inference path.
+
+Example, from deployment/model/code:
+    python -m activity_detection --model-dir .. --videos ./segments --output predictions.jsonl
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+from .models import load_models
+from .predict import score_directory
+from .sinks import DynamoDBSink, FileSink, JsonSink
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the activity detection models over a directory of videos')
+    parser.add_argument('--model-dir', type=str, required=True, help='directory with the exported model(s)')
+    parser.add_argument('--videos', type=str, required=True, help='directory of video segments')
+    parser.add_argument('--output', type=str, default=None, help='append the predictions to this json lines file')
+    parser.add_argument('--table-name', type=str, default=None, help='write the predictions to this DynamoDB table')
+    parser.add_argument('--variant', type=str, default=None, help='serving variant of a single model')
+    parser.add_argument('--max-frames', type=int, default=32)
+    parser.add_argument('--top-k', type=int, default=1)
+    args = parser.parse_args()
+    if args.output and args.table_name:
+        parser.error('give at most one of --output and --table-name')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    models = load_models(args.model_dir, variant_name=args.variant)
+    if args.output:
+        sink = FileSink(args.output)
+    elif args.table_name:
+        sink = DynamoDBSink(args.table_name)
+    else:
+        sink = JsonSink()
+
+    tic = time.time()
+    responses = score_directory(models, args.videos, sink, max_frames=args.max_frames, TOP_K=args.top_k)
+    sink.close()
+    if not args.output:
+        for response in responses:
+            print(json.dumps(response['Item']))
+    elapsed = time.time() - tic
+    print('scored {} videos in {:.1f}s ({:.2f} videos/sec)'.format(
+        len(responses), elapsed, len(responses) / max(elapsed, 1e-6)))
@@ -0,0 +1,288 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Score archived footage offline, without going through the endpoint.
+
+Videos are listed from a local directory or an S3 prefix, fetched and decoded
+by a pool of processes, and run through the models in batches of clips in this
+process. At most `--max-in-flight` videos are queued for or held after decoding,
+so a model slower than the decoders doesn't pile up clips in memory, and the
+decode pool defaults to the cores left over by the model's threads. The records (the same as the endpoint's) are written as Parquet or CSV
+part files to the output directory and optionally to DynamoDB in batches.
+
+Progress is checkpointed in `_progress.jsonl` in the output directory each time
+a part file is written, so an interrupted run picks up where it stopped when
+started again with the same output directory. Videos that failed are retried.
+Scoring is at least once: videos of a part written just before a crash are
+scored again on resume, deduplicate the outputs on S3Path if that matters.
+
+Segments are scored independently, there is no motion gate or per-stream smoothing.
+
+Example, from deployment/model/code:
+    python -m activity_detection.batch --model-dir .. --input s3://<bucket>/archive/ \\
+        --output ./scores --format parquet --table-name activity-detection-table
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import time
+
+from collections import OrderedDict, deque
+from itertools import islice
+
+import boto3
+import cv2
+import numpy as np
+from mxnet import nd
+
+from . import video
+from .models import load_models
+from .placement import available_cores, set_num_threads
+from .predict import VIDEO_EXTENSIONS, format_prediction, list_videos, make_item
+from .sinks import BatchDynamoDBSink
+from .video import INPUT_SIZE, crop_frames, is_s3_path, normalize_clips, read_video_frames, subsample_frames
+
+PROGRESS_FILE = '_progress.jsonl'
+
+
+def list_inputs(source, extensions=VIDEO_EXTENSIONS):
+    """The videos of a local directory or an S3 prefix, sorted."""
+    if not is_s3_path(source):
+        return list_videos(source, extensions)
+    bucket, _, prefix = source[len('s3://'):].partition('/')
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    paths = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        paths += ['s3://{}/{}'.format(bucket, obj['Key']) for obj in page.get('Contents', [])
+                  if obj['Key'].lower().endswith(extensions)]
+    return sorted(paths)
+
+
+def init_decode_worker(threads):
+    #the pool already uses every core, keep OpenCV and decord from spawning threads of their own
+    cv2.setNumThreads(threads)
+    video.DECODE_THREADS = threads
+
+
+def decode_clip(task):
+    """Fetch and decode one video into a center cropped uint8 clip. Runs in the pool."""
+    path, num_frames = task
+    try:
+        clip = crop_frames(read_video_frames(path, num_frames))
+        if clip.shape[1:3] != (INPUT_SIZE, INPUT_SIZE):
+            raise ValueError('frames of {}x{} are smaller than the {} input'.format(
+                clip.shape[2], clip.shape[1], INPUT_SIZE))
+        return path, np.ascontiguousarray(clip), None
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def score_clips(models, paths, clips, max_frames=32, top_k=1):
+    """Run every model on a batch of decoded clips. Returns one record per path."""
+    video_input = nd.array(normalize_clips(np.stack(clips)))
+    results = [OrderedDict() for _ in paths]
+    for name, model in models.items():
+        num_frames = min(max_frames, model['num_frames'] or max_frames)
+        model_input = subsample_frames(video_input.as_in_context(model['ctx']), num_frames)
+        probs = model['net'](model_input).asnumpy()
+        for result, row in zip(results, probs):
+            result[name] = format_prediction(row, model['classes'], top_k)
+    return [make_item(path, result, len(models) > 1) for path, result in zip(paths, results)]
+
+
+def item_to_row(item):
+    """Flatten a DynamoDB-style record into a table row."""
+    row = {
+        'S3Path': item['S3Path']['S'],
+        'DateCreatedUTC': item['DateCreatedUTC']['S'],
+        'Predicted': item['Predicted']['S'],
+        'Probability': float(item['Probability']['S']),
+    }
+    if 'TopK' in item:
+        row['TopK'] = json.dumps([(e['M']['Label']['S'], float(e['M']['Probability']['S']))
+                                  for e in item['TopK']['L']])
+    if 'Models' in item:
+        row['Models'] = json.dumps(dict((name, result['M']['Predicted']['S'])
+                                        for name, result in item['Models']['M'].items()))
+    return row
+
+
+class Checkpoint(object):
+    """The videos already scored, appended to a json lines file as part files are written."""
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, PROGRESS_FILE)
+        self.done = set()
+        self.failed = {}
+        if os.path.exists(self.path):
+            with open(self.path) as fopen:
+                for line in fopen:
+                    entry = json.loads(line)
+                    if entry['status'] == 'ok':
+                        self.done.add(entry['path'])
+                        self.failed.pop(entry['path'], None)
+                    else:
+                        self.failed[entry['path']] = entry['error']
+
+    def record(self, entries):
+        with open(self.path, 'a') as fopen:
+            for entry in entries:
+                fopen.write(json.dumps(entry) + '\n')
+            fopen.flush()
+            os.fsync(fopen.fileno())
+        for entry in entries:
+            if entry['status'] == 'ok':
+                self.done.add(entry['path'])
+                self.failed.pop(entry['path'], None)
+            else:
+                self.failed[entry['path']] = entry['error']
+
+
+class PartWriter(object):
+    """Write the buffered rows as numbered Parquet or CSV part files."""
+    def __init__(self, output_dir, file_format='parquet'):
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.rows = []
+        self.index = len(glob.glob(os.path.join(output_dir, 'part-*.' + file_format)))
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        import pandas as pd
+        if not self.rows:
+            return None
+        path = os.path.join(self.output_dir, 'part-{:05d}.{}'.format(self.index, self.file_format))
+        frame = pd.DataFrame(self.rows)
+        if self.file_format == 'parquet':
+            frame.to_parquet(path, index=False)
+        else:
+            frame.to_csv(path, index=False)
+        self.index += 1
+        self.rows = []
+        return path
+
+
+def run(args):
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    checkpoint = Checkpoint(args.output)
+    num_cores = len(available_cores())
+    model_threads = args.model_threads or max(num_cores // 4, 1)
+    num_workers = args.num_workers or max(num_cores - model_threads, 1)
+    max_in_flight = args.max_in_flight or 4 * args.batch_size
+    print('{} decode processes, {} model threads, at most {} videos in flight'.format(
+        num_workers, model_threads, max_in_flight))
+    #fork the decode pool before any model or boto3 client exists in this process
+    pool = mp.Pool(num_workers, initializer=init_decode_worker, initargs=(args.decode_threads,))
+    set_num_threads(model_threads)
+    models = load_models(args.model_dir, variant_name=args.variant)
+    writer = PartWriter(args.output, args.format)
+    sink = BatchDynamoDBSink(args.table_name) if args.table_name else None
+
+    videos = list_inputs(args.input)
+    todo = [path for path in videos if path not in checkpoint.done]
+    print('{} videos, {} already scored, {} to go ({} failed before)'.format(
+        len(videos), len(videos) - len(todo), len(todo), len(checkpoint.failed)))
+
+    stats = {'scored': 0, 'failed': 0, 'decode_wait': 0.0, 'model': 0.0}
+    entries, paths, clips = [], [], []
+
+    def score():
+        tic = time.time()
+        for item in score_clips(models, paths, clips, args.max_frames, args.top_k):
+            writer.add(item_to_row(item))
+            if sink:
+                sink.write(item)
+            entries.append({'path': item['S3Path']['S'], 'status': 'ok'})
+        stats['model'] += time.time() - tic
+        stats['scored'] += len(paths)
+        del paths[:], clips[:]
+
+    def commit():
+        part = writer.flush()
+        if sink:
+            sink.flush()
+        checkpoint.record(entries)
+        del entries[:]
+        elapsed = time.time() - start
+        done = stats['scored'] + stats['failed']
+        print('[{}/{}] {:.2f} videos/sec, {:.0f}s waiting for decode, {:.0f}s in the model, {} failed{}'.format(
+            done, len(todo), stats['scored'] / max(elapsed, 1e-6), stats['decode_wait'],
+            stats['model'], stats['failed'], ', wrote ' + part if part else ''))
+
+    start = time.time()
+    tic = time.time()
+    tasks = ((path, args.max_frames) for path in todo)
+    pending = deque()
+
+    def submit():
+        #top the window back up, results are consumed in submission order
+        for task in islice(tasks, max_in_flight - len(pending)):
+            pending.append(pool.apply_async(decode_clip, (task,)))
+
+    submit()
+    while pending:
+        path, clip, error = pending.popleft().get()
+        stats['decode_wait'] += time.time() - tic
+        submit()
+        if error:
+            stats['failed'] += 1
+            entries.append({'path': path, 'status': 'failed', 'error': error})
+        else:
+            paths.append(path)
+            clips.append(clip)
+            if len(paths) == args.batch_size:
+                score()
+        if len(entries) >= args.flush_every:
+            commit()
+        tic = time.time()
+    if paths:
+        score()
+    commit()
+    pool.close()
+    pool.join()
+    if sink:
+        sink.close()
+    if checkpoint.failed:
+        print('{} videos failed, rerun to retry them, see {}'.format(len(checkpoint.failed), checkpoint.path))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Score a directory or S3 prefix of videos in batch')
+    parser.add_argument('--model-dir', type=str, required=True, help='directory with the exported model(s)')
+    parser.add_argument('--input', type=str, required=True, help='local directory or s3://bucket/prefix of videos')
+    parser.add_argument('--output', type=str, required=True, help='local directory for the part files and progress')
+    parser.add_argument('--format', type=str, default='parquet', choices=['parquet', 'csv'])
+    parser.add_argument('--table-name', type=str, default=None, help='also write the records to this DynamoDB table')
+    parser.add_argument('--variant', type=str, default=None, help='serving variant of a single model')
+    parser.add_argument('--max-frames', type=int, default=32)
+    parser.add_argument('--top-k', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=8, help='clips per forward pass')
+    parser.add_argument('--model-threads', type=int, default=0,
+                        help='OpenMP threads of the models, 0 for a quarter of the cores (1 is enough on a GPU)')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='decode processes, 0 for the cores not used by the model threads')
+    parser.add_argument('--decode-threads', type=int, default=1, help='OpenCV threads per decode process')
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help='videos queued for or held after decoding at most, 0 for four batches')
+    parser.add_argument('--flush-every', type=int, default=1000, help='videos per part file and checkpoint')
+    args = parser.parse_args()
+    if args.format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            try:
+                import fastparquet
+            except ImportError:
+                parser.error('--format parquet needs pyarrow or fastparquet, install one or use --format csv')
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
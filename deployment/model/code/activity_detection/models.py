@@ -0,0 +1,128 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Load the exported models, their serving variants and classes."""
+
+from __future__ import print_function
+
+import json
+import os
+
+from collections import OrderedDict
+
+import mxnet as mx
+from mxnet import gluon
+import numpy as np
+
+#written by the training export step, lists the serving variants of the model
+VARIANTS_MANIFEST = 'variants.json'
+#optional, lists several models to host side by side on the same decoded clip
+MODELS_MANIFEST = 'models.json'
+CLASSES_FILE = 'classes.txt'
+
+
+def default_context():
+    return mx.gpu() if mx.context.num_gpus() else mx.cpu()
+
+
+def load_models(model_dir, classes_path=None, variant_name=None, ctx=None):
+    """
+    Load the gluon models of a model directory.
+
+    With a models manifest (models.json) in the model directory, every model it
+    lists is loaded from its own subdirectory, e.g.
+    {"models": [{"name": "ucf101", "dir": "ucf101", "classes": "classes.txt"}]}.
+    Otherwise the single model in the model directory is loaded as "default",
+    with the classes from classes_path (classes.txt in the model directory by default).
+    All models are loaded on ctx, the GPU if there is one by default.
+
+    :param: model_dir The directory where model files are stored.
+    :return: an ordered dict of model name to loaded model
+    """
+    manifest_path = os.path.join(model_dir, MODELS_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fopen:
+            specs = json.load(fopen)['models']
+    else:
+        specs = [{'name': 'default', 'dir': '.', 'classes': classes_path or CLASSES_FILE,
+                  'variant': variant_name}]
+
+    models = OrderedDict()
+    for spec in specs:
+        model_subdir = os.path.join(model_dir, spec.get('dir', spec['name']))
+        classes_path = os.path.join(model_subdir, spec.get('classes', CLASSES_FILE))
+        model = models[spec['name']] = load_model(model_subdir, classes_path, spec.get('variant'), ctx)
+        message = 'Loaded model {}: {:.1f} MB of parameters'.format(spec['name'], model['param_bytes'] / 1e6)
+        if model['gpu_free_delta_bytes'] is not None:
+            message += ', GPU free memory dropped by ~{:.1f} MB during the load'.format(model['gpu_free_delta_bytes'] / 1e6)
+        print(message)
+    return models
+
+
+def load_model(model_dir, classes_path, variant_name=None, ctx=None):
+    """
+    Load one model with its classes and record how much memory it takes.
+
+    If the model directory has a variants manifest, the named variant (or the
+    manifest default) is loaded.
+    """
+    prefix, num_frames = 'model', None
+    manifest_path = os.path.join(model_dir, VARIANTS_MANIFEST)
+    if os.path.exists(manifest_path):
+        variant = select_variant(manifest_path, variant_name)
+        prefix, num_frames = variant['prefix'], variant['num_frames']
+        print('Serving model variant {}'.format(variant['name']))
+
+    ctx = ctx or default_context()
+    free_before = mx.context.gpu_memory_info(ctx.device_id)[0] if ctx.device_type == 'gpu' else 0
+
+    symbol = mx.sym.load('%s/%s-symbol.json' % (model_dir, prefix))
+    outputs = mx.symbol.softmax(data=symbol, name='softmax_label')
+    inputs = mx.sym.var('data')
+    net = gluon.SymbolBlock(outputs, inputs)
+    net.load_parameters('%s/%s-0000.params' % (model_dir, prefix), ctx=ctx)
+
+    #the per-model figure. The drop in free GPU memory is only approximate: it includes what
+    #the MXNet memory pool reserves and the allocations of other workers sharing the GPU
+    param_bytes = sum(param.data(ctx).size * np.dtype(param.dtype).itemsize
+                      for param in net.collect_params().values())
+    gpu_free_delta_bytes = None
+    if ctx.device_type == 'gpu':
+        gpu_free_delta_bytes = free_before - mx.context.gpu_memory_info(ctx.device_id)[0]
+
+    if os.path.exists(classes_path):
+        classes = read_classes(classes_path)
+    else:
+        #models exported before the training job wrote classes.txt, label by class index
+        num_classes = net(mx.nd.zeros((1, 3, num_frames or 32, 224, 224), ctx=ctx)).shape[1]
+        classes = [str(i) for i in range(num_classes)]
+        print('No classes file at {}, predictions are labelled with class indices'.format(classes_path))
+    return {
+        'net': net,
+        'ctx': ctx,
+        'classes': dict(zip(range(len(classes)), classes)),
+        #clip length the variant was evaluated at, caps MODEL_MAX_FRAMES
+        'num_frames': num_frames,
+        'param_bytes': param_bytes,
+        'gpu_free_delta_bytes': gpu_free_delta_bytes,
+    }
+
+
+def select_variant(manifest_path, name=None):
+    """Pick a model variant from the manifest by name, defaulting to the manifest's choice."""
+    with open(manifest_path, 'r') as fopen:
+        manifest = json.load(fopen)
+    name = name or manifest['default']
+    for variant in manifest['variants']:
+        if variant['name'] == name:
+            return variant
+    raise ValueError('Unknown model variant {}, available: {}'.format(
+        name, ', '.join(v['name'] for v in manifest['variants'])))
+
+
+def read_classes(classes_path='classes.txt'):
+    """Load list of classes from local txt file."""
+    with open(classes_path, 'r') as fopen:
+        classes = fopen.readlines()
+    classes = [clas.strip() for clas in classes]
+    return classes
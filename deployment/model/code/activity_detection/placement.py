@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Place each model server worker on its own device.
+
+The model server starts SAGEMAKER_MODEL_SERVER_WORKERS processes that each load
+the model. Without placement they all use GPU 0, and on CPU every worker runs
+with as many OpenMP threads as the instance has cores. Here every worker claims
+a slot (a lock file held for the life of the process, so the slot of a
+restarted worker is reused), and the slot decides
+
+* on GPU instances: the GPU, round robin over the GPUs;
+* on every instance: the range of CPU cores the worker is pinned to (disjoint
+  as long as there are at least as many cores as workers), and the number of
+  OpenMP (MXNet, MKL-DNN), OpenCV and decoder threads, one per core by default
+  or OMP_THREADS_PER_WORKER.
+
+WORKER_PLACEMENT=off keeps the old behavior.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import fcntl
+import os
+
+import mxnet as mx
+
+#auto places the workers, off leaves them on the default device with default threading
+WORKER_PLACEMENT = os.environ.get('WORKER_PLACEMENT', 'auto')
+#0 gives each worker one thread per core of its share
+OMP_THREADS_PER_WORKER = int(os.environ.get('OMP_THREADS_PER_WORKER') or 0)
+WORKER_SLOTS_DIR = os.environ.get('WORKER_SLOTS_DIR', '/tmp/activity-detection-workers')
+
+#the lock file of the claimed slot stays open as long as the worker lives
+_SLOT_FILE = None
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def num_server_workers():
+    #not set when the inference code runs outside the model server, the process gets the whole instance
+    return int(os.environ.get('SAGEMAKER_MODEL_SERVER_WORKERS') or 1)
+
+
+def claim_worker_slot(num_workers, slots_dir=WORKER_SLOTS_DIR):
+    """Lock the lowest free slot in [0, num_workers). Falls back to the pid when all are taken."""
+    global _SLOT_FILE
+    if not os.path.exists(slots_dir):
+        try:
+            os.makedirs(slots_dir)
+        except OSError:
+            pass
+    for slot in range(num_workers):
+        fopen = open(os.path.join(slots_dir, 'slot-{}.lock'.format(slot)), 'w')
+        try:
+            fcntl.flock(fopen, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            fopen.close()
+            continue
+        _SLOT_FILE = fopen
+        return slot
+    return os.getpid() % num_workers
+
+
+def plan_placement(slot, num_workers, num_gpus, cores, threads_per_worker=0):
+    """The device, cores and thread count of the worker in slot."""
+    per_worker = max(len(cores) // num_workers, 1)
+    start = (slot * per_worker) % len(cores)
+    worker_cores = cores[start:start + per_worker]
+    return {
+        'slot': slot,
+        'workers': num_workers,
+        'gpu': slot % num_gpus if num_gpus else None,
+        'cores': worker_cores,
+        'threads': threads_per_worker or len(worker_cores),
+    }
+
+
+def set_num_threads(threads):
+    """Limit the threads of this process's OpenMP pool and of OpenCV."""
+    import cv2
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    try:
+        #the engine has already read OMP_NUM_THREADS when mxnet was imported
+        mx.base._LIB.MXSetNumOMPThreads(ctypes.c_int(threads))
+    except AttributeError:
+        pass
+    cv2.setNumThreads(threads)
+
+
+def apply_placement(placement):
+    """Pin this process to the cores of the placement and size its thread pools. Returns the context."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, placement['cores'])
+    set_num_threads(placement['threads'])
+    from . import video
+    video.DECODE_THREADS = placement['threads']
+    return mx.gpu(placement['gpu']) if placement['gpu'] is not None else mx.cpu()
+
+
+def place_worker():
+    """Claim a slot for this worker and place it. Returns the context to load the models on."""
+    num_gpus = mx.context.num_gpus()
+    if WORKER_PLACEMENT == 'off':
+        return mx.gpu() if num_gpus else mx.cpu()
+    num_workers = num_server_workers()
+    slot = claim_worker_slot(num_workers)
+    placement = plan_placement(slot, num_workers, num_gpus, available_cores(), OMP_THREADS_PER_WORKER)
+    ctx = apply_placement(placement)
+    print('Worker {} (slot {} of {}) on {}, cores {}, {} threads'.format(
+        os.getpid(), slot, num_workers, ctx, ','.join(str(c) for c in placement['cores']),
+        placement['threads']))
+    return ctx
@@ -0,0 +1,358 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Run the models on segments: motion gate, inference, smoothing and the result record."""
+
+from __future__ import print_function
+
+import os
+import re
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+import boto3
+import numpy as np
+
+from .resources import peak_rss_bytes, reset_peak_rss
+from .video import MAX_WINDOWS, VideoLimitExceeded, motion_score, preprocess_frames, read_video_windows, subsample_frames
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z%z'
+VIDEO_EXTENSIONS = ('.ts', '.mp4', '.avi', '.mov', '.mkv')
+#segments whose motion score is below the threshold skip the full model, 0 disables the gate
+MOTION_THRESHOLD = float(os.environ.get('MOTION_THRESHOLD', 0))
+#optional lighter model from the models manifest that gated segments are routed to
+MOTION_GATE_MODEL = os.environ.get('MOTION_GATE_MODEL')
+NO_ACTIVITY = 'NoActivity'
+#number of top classes stored with each prediction
+TOP_K = int(os.environ.get('TOP_K', 1))
+#weight of the newest segment in the per-stream moving average, 1 disables smoothing
+SMOOTHING_ALPHA = float(os.environ.get('SMOOTHING_ALPHA', 1.0))
+SMOOTHING_MAX_STREAMS = int(os.environ.get('SMOOTHING_MAX_STREAMS', 256))
+SMOOTHING_IDLE_SECONDS = float(os.environ.get('SMOOTHING_IDLE_SECONDS', 600))
+#only write a record to DynamoDB when the predicted label of a stream changes
+PERSIST_CHANGES_ONLY = os.environ.get('PERSIST_CHANGES_ONLY', 'false').lower() in ('true', '1', 'yes')
+#DynamoDB table shared by all workers and instances for the per-stream state of the smoothing and
+#of PERSIST_CHANGES_ONLY, without it the state is kept in each worker's memory
+STREAM_STATE_TABLE = os.environ.get('STREAM_STATE_TABLE')
+
+
+class MotionGateStats(object):
+    """Gate hit rate and the inference time saved by the gate in this worker."""
+    def __init__(self, log_every=100):
+        self.log_every = log_every
+        self.segments = 0
+        self.gated = 0
+        self.full_time = 0.0
+        self.full_count = 0
+        self.time_saved = 0.0
+
+    def update(self, gated, elapsed):
+        self.segments += 1
+        if gated:
+            self.gated += 1
+            #estimate the saving from the average cost of the segments that ran the full path
+            if self.full_count:
+                self.time_saved += max(self.full_time / self.full_count - elapsed, 0.0)
+        else:
+            self.full_time += elapsed
+            self.full_count += 1
+        if self.segments % self.log_every == 0:
+            print('Motion gate: {}/{} segments gated ({:.1f}%), {:.1f}s of inference saved'.format(
+                self.gated, self.segments, 100.0 * self.gated / self.segments, self.time_saved))
+
+
+class LocalStreamState(object):
+    """Per-stream state in this worker's memory.
+
+    The state of a stream maps each model to its averaged probabilities and last
+    label. It is only right when every segment of a stream reaches this worker:
+    a single model server worker on a single instance, or a local run. Streams
+    not seen for idle_seconds, or the least recently seen ones beyond
+    max_streams, are evicted.
+    """
+    def __init__(self, max_streams=256, idle_seconds=600):
+        self.max_streams = max_streams
+        self.idle_seconds = idle_seconds
+        self.streams = OrderedDict()
+
+    def update(self, stream, fn):
+        """Replace the state of a stream by the first value of fn(state), return the second."""
+        now = time.time()
+        entry = self.streams.pop(stream, None) or {'state': {}}
+        entry['seen'] = now
+        self.streams[stream] = entry
+        while self.streams:
+            oldest = next(iter(self.streams.values()))
+            if len(self.streams) <= self.max_streams and now - oldest['seen'] <= self.idle_seconds:
+                break
+            self.streams.popitem(last=False)
+        entry['state'], result = fn(entry['state'])
+        return result
+
+
+class DynamoDBStreamState(object):
+    """Per-stream state in a DynamoDB table, shared by all workers and instances.
+
+    Each stream is one item keyed by StreamId. An update reads the item and writes
+    the new state on the condition that its Version is unchanged; when another
+    worker wrote the stream in between, the update is redone on the new state.
+    Items expire idle_seconds after their last update (ExpiresAt, the table's TTL).
+    """
+    def __init__(self, table_name, idle_seconds=600, client=None, max_retries=10):
+        self.table_name = table_name
+        self.idle_seconds = idle_seconds
+        self.client = client
+        self.max_retries = max_retries
+
+    def _read(self, stream):
+        response = self.client.get_item(TableName=self.table_name, Key={'StreamId': {'S': stream}},
+                                        ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            return {}, None
+        state = {}
+        for name, model in item['Models']['M'].items():
+            model = model['M']
+            state[name] = {
+                'probs': np.frombuffer(bytes(model['Probs']['B']), dtype=np.float32) if 'Probs' in model else None,
+                'label': model['Label']['S'] if 'Label' in model else None,
+            }
+        return state, int(item['Version']['N'])
+
+    def _write(self, stream, state, version):
+        models = {}
+        for name, entry in state.items():
+            model = {}
+            if entry['probs'] is not None:
+                model['Probs'] = {'B': np.asarray(entry['probs'], dtype=np.float32).tobytes()}
+            if entry['label'] is not None:
+                model['Label'] = {'S': entry['label']}
+            models[name] = {'M': model}
+        item = {
+            'StreamId': {'S': stream},
+            'Version': {'N': str((version or 0) + 1)},
+            'Models': {'M': models},
+            'ExpiresAt': {'N': str(int(time.time() + self.idle_seconds))},
+        }
+        if version is None:
+            self.client.put_item(TableName=self.table_name, Item=item,
+                                 ConditionExpression='attribute_not_exists(StreamId)')
+        else:
+            self.client.put_item(TableName=self.table_name, Item=item, ConditionExpression='Version = :version',
+                                 ExpressionAttributeValues={':version': {'N': str(version)}})
+
+    def update(self, stream, fn):
+        """Replace the state of a stream by the first value of fn(state), return the second."""
+        if self.client is None:
+            self.client = boto3.client('dynamodb')
+        for attempt in range(self.max_retries + 1):
+            state, version = self._read(stream)
+            state, result = fn(state)
+            try:
+                self._write(stream, state, version)
+                return result
+            except self.client.exceptions.ConditionalCheckFailedException:
+                time.sleep(min(0.01 * 2 ** attempt, 0.5))
+        raise RuntimeError('State of stream {} kept changing, gave up after {} retries'.format(
+            stream, self.max_retries))
+
+
+GATE_STATS = MotionGateStats()
+if STREAM_STATE_TABLE:
+    STREAM_STATE = DynamoDBStreamState(STREAM_STATE_TABLE, SMOOTHING_IDLE_SECONDS)
+else:
+    STREAM_STATE = LocalStreamState(SMOOTHING_MAX_STREAMS, SMOOTHING_IDLE_SECONDS)
+    if (SMOOTHING_ALPHA < 1.0 or PERSIST_CHANGES_ONLY) and int(os.environ.get('SAGEMAKER_MODEL_SERVER_WORKERS') or 1) > 1:
+        print('Warning: without STREAM_STATE_TABLE each of the {} workers keeps its own stream state, the smoothing '
+              'and PERSIST_CHANGES_ONLY only work when all segments of a stream reach the same worker'.format(
+                  os.environ['SAGEMAKER_MODEL_SERVER_WORKERS']))
+
+
+def stream_key(s3_video_path):
+    """Identify the stream of a segment: its S3 prefix and file name without the segment number."""
+    return re.sub(r'[_.-]?\d+\.\w+$', '', s3_video_path)
+
+
+def format_prediction(probs, classes, top_k=1, return_probabilities=False):
+    """DynamoDB attributes for the top class, and optionally the top-k and all probabilities."""
+    top = np.argsort(probs)[::-1][:max(top_k, 1)]
+    result = {
+        'Predicted': {'S': classes[int(top[0])]},
+        'Probability': {'S': '{:.4f}'.format(probs[top[0]])},
+    }
+    if top_k > 1:
+        result['TopK'] = {'L': [{'M': {'Label': {'S': classes[int(i)]},
+                                       'Probability': {'S': '{:.4f}'.format(probs[i])}}} for i in top]}
+    if return_probabilities:
+        result['Probabilities'] = {'L': [{'N': '{:.6f}'.format(p)} for p in probs]}
+    return result
+
+
+def update_stream(state, probs, fixed, models, top_k=1, return_probabilities=False, alpha=SMOOTHING_ALPHA):
+    """Smooth the probabilities of a segment with the state of its stream.
+
+    probs are the class probabilities of the segment per model and fixed the results
+    that do not come from probabilities (NoActivity). Returns the new state and, as
+    the result of the update, the formatted results and whether a label changed.
+    """
+    results = OrderedDict(fixed)
+    smoothed = {}
+    for name, model_probs in probs.items():
+        previous = state.get(name, {}).get('probs')
+        if alpha < 1.0 and previous is not None and previous.shape == model_probs.shape:
+            model_probs = alpha * model_probs + (1.0 - alpha) * previous
+        smoothed[name] = model_probs
+        results[name] = format_prediction(model_probs, models[name]['classes'], top_k, return_probabilities)
+    new_state = dict(state)
+    changed = False
+    for name, result in results.items():
+        previous = state.get(name, {})
+        label = result['Predicted']['S']
+        changed = previous.get('label') != label or changed
+        new_state[name] = {'probs': smoothed.get(name, previous.get('probs')), 'label': label}
+    return new_state, (results, changed)
+
+
+def make_item(video_path, results, multi_model=False):
+    """The DynamoDB record of a segment from the formatted prediction of each model."""
+    #the first model keeps the top-level attributes of the single-model record
+    item = {
+        'S3Path': {'S': video_path},
+        'DateCreatedUTC': {'S': datetime.utcnow().strftime(TIME_FORMAT)},
+    }
+    item.update(next(iter(results.values())))
+    if multi_model:
+        item['Models'] = {'M': {name: {'M': result} for name, result in results.items()}}
+    return item
+
+
+def predict_request(models, data, sink):
+    """Handle one request payload: a single S3_VIDEO_PATH, or an S3_VIDEO_PATHS batch processed in order.
+
+    A video over the size or duration limits gets a 413 status instead of a prediction.
+    """
+    if 'S3_VIDEO_PATHS' in data:
+        segments = [dict(data, S3_VIDEO_PATH=path) for path in data['S3_VIDEO_PATHS']]
+    else:
+        segments = [data]
+    response = []
+    for segment in segments:
+        segment.pop('S3_VIDEO_PATHS', None)
+        try:
+            response.append(predict_segment(models, segment, sink))
+        except VideoLimitExceeded as e:
+            response.append({'StatusCode': 413, 'Message': str(e)})
+    return response if 'S3_VIDEO_PATHS' in data else response[0]
+
+
+def run_models(selected, model_frames, frames):
+    """Class probabilities of every selected model on one decoded clip."""
+    video_input = preprocess_frames(frames, max(model_frames))
+    probs = OrderedDict()
+    for (name, model), num_frames in zip(selected, model_frames):
+        video_input = video_input.as_in_context(model['ctx'])
+        probs[name] = model['net'](subsample_frames(video_input, num_frames)).asnumpy()[0]
+    return probs
+
+
+def predict_segment(models, data, sink, frames=None):
+    """Run the requested models on one segment and write the result to the sink.
+
+    frames are the already decoded frames of the segment, by default the segment
+    is fetched and decoded here. A video longer than WINDOW_SECONDS is decoded and
+    scored one window at a time (at most MAX_WINDOWS in the payload, between 1 and
+    the server's MAX_WINDOWS) and the probabilities of the windows are averaged.
+    Returns the sink's status with the record as 'Item'.
+    """
+    reset_peak_rss()
+    selected = [(name, models[name]) for name in data.get('MODELS') or list(models)]
+    stream = data.get('STREAM_ID') or stream_key(data['S3_VIDEO_PATH'])
+    top_k = int(data.get('TOP_K', TOP_K))
+    return_probabilities = str(data.get('RETURN_PROBABILITIES', 'false')).lower() in ('true', '1', 'yes')
+
+    #decode for the model that needs the longest clip, the others take a subset of its frames
+    max_frames = data['MODEL_MAX_FRAMES']
+    model_frames = [min(max_frames, model['num_frames'] or max_frames) for _, model in selected]
+    if frames is None:
+        #a request can score fewer windows than the server allows, not more, and always at least one
+        max_windows = max(1, min(MAX_WINDOWS, int(data.get('MAX_WINDOWS', MAX_WINDOWS))))
+        windows = read_video_windows(data['S3_VIDEO_PATH'], max(model_frames), max_windows)
+    else:
+        windows = [frames]
+
+    #cascade: a cheap motion score on the sampled frames decides whether the window is worth the full model
+    start = time.time()
+    threshold = float(data.get('MOTION_THRESHOLD', MOTION_THRESHOLD))
+    gate_model = [(MOTION_GATE_MODEL, models[MOTION_GATE_MODEL])] if MOTION_GATE_MODEL in models else []
+    gate_frames = [min(max_frames, model['num_frames'] or max_frames) for _, model in gate_model]
+    sums, gate_sums, scores = OrderedDict(), OrderedDict(), []
+    num_windows = 0
+    for frames in windows:
+        num_windows += 1
+        score = motion_score(frames) if threshold > 0 else None
+        scores.append(score)
+        if score is not None and score < threshold:
+            #route static windows to the lighter model only, if there is one
+            target, target_frames = gate_sums, gate_frames
+            window_models = gate_model
+        else:
+            target, target_frames = sums, model_frames
+            window_models = selected
+        if window_models:
+            for name, probs in run_models(window_models, target_frames, frames).items():
+                target[name] = target.get(name, 0) + probs
+        del frames
+
+    #the segment is gated when every window was static
+    score = max(scores) if scores and scores[0] is not None else None
+    gated = not sums and score is not None
+    fixed = OrderedDict()
+    if gated and not gate_sums:
+        for name, _ in selected:
+            fixed[name] = {'Predicted': {'S': NO_ACTIVITY}, 'Probability': {'S': '1.0000'}}
+    windows_scored = num_windows - sum(1 for s in scores if s is not None and s < threshold)
+    probs = OrderedDict((name, summed / float(num_windows if gated else windows_scored))
+                        for name, summed in (gate_sums if gated else sums).items())
+    if score is not None:
+        GATE_STATS.update(gated, time.time() - start)
+
+    #the stream state is only read and written when the smoothing or the sink need it
+    update = lambda state: update_stream(state, probs, fixed, models, top_k, return_probabilities)
+    if SMOOTHING_ALPHA < 1.0 or getattr(sink, 'changes_only', False):
+        results, changed = STREAM_STATE.update(stream, update)
+    else:
+        results, changed = update({})[1]
+
+    item = make_item(data['S3_VIDEO_PATH'], results, len(models) > 1)
+    if score is not None:
+        item['MotionScore'] = {'S': '{:.4f}'.format(score)}
+        item['Gated'] = {'BOOL': gated}
+    if num_windows > 1:
+        item['Windows'] = {'N': str(num_windows)}
+    item['PeakRSSMB'] = {'N': '{:.1f}'.format(peak_rss_bytes() / 1e6)}
+
+    response = sink.write(item, changed)
+    response['Item'] = item
+    return response
+
+
+def list_videos(video_dir, extensions=VIDEO_EXTENSIONS):
+    """The video files under a directory, sorted so segments of a stream are in order."""
+    paths = []
+    for root, _, files in os.walk(video_dir):
+        paths += [os.path.join(root, f) for f in files if f.lower().endswith(extensions)]
+    return sorted(paths)
+
+
+def score_directory(models, video_dir, sink, max_frames=32, **options):
+    """Run the production path over every video in a directory, one segment at a time.
+
+    options are extra payload fields such as TOP_K or MODELS. Returns the responses.
+    """
+    responses = []
+    for path in list_videos(video_dir):
+        data = dict(options, S3_VIDEO_PATH=path, MODEL_MAX_FRAMES=max_frames)
+        responses.append(predict_segment(models, data, sink))
+    return responses
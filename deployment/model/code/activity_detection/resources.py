@@ -0,0 +1,34 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Memory accounting of the worker process."""
+
+from __future__ import print_function
+
+import resource
+
+
+def reset_peak_rss():
+    """Start a new peak RSS measurement. Returns False where the kernel does not support it.
+
+    Writing 5 to clear_refs resets the VmHWM high water mark of the process (Linux 4.0+).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fopen:
+            fopen.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process since the last reset (or since it started)."""
+    try:
+        with open('/proc/self/status') as fopen:
+            for line in fopen:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    #ru_maxrss is in kilobytes on Linux and covers the whole life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
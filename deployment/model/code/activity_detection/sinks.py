@@ -0,0 +1,123 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Where predictions go: a DynamoDB table, the response only, or a local file.
+
+A sink's write(item, changed) gets the DynamoDB-style record of one segment and
+whether the predicted label of its stream changed, and returns a status dict.
+"""
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+import boto3
+
+
+class JsonSink(object):
+    """Return the prediction in the response only."""
+    def write(self, item, changed=True):
+        return {'StatusCode': 200, 'Message': 'Not persisted, no table given'}
+
+    def close(self):
+        pass
+
+
+class DynamoDBSink(object):
+    """Put each prediction in a DynamoDB table."""
+    def __init__(self, table_name, changes_only=False, client=None):
+        self.table_name = table_name
+        self.changes_only = changes_only
+        self.client = client
+
+    def write(self, item, changed=True):
+        if self.changes_only and not changed:
+            return {'StatusCode': 200, 'Message': 'Skipped, label unchanged'}
+        if self.client is None:
+            self.client = boto3.client('dynamodb')
+        return save_to_dynamodb(item, self.table_name, self.client)
+
+    def close(self):
+        pass
+
+
+class BatchDynamoDBSink(object):
+    """Buffer predictions and write them with BatchWriteItem, 25 items per call.
+
+    Unprocessed items (throttling) are retried with exponential backoff. Call
+    flush() before recording the buffered items as done, and close() at the end.
+    """
+    MAX_BATCH = 25
+
+    def __init__(self, table_name, client=None, max_retries=8):
+        self.table_name = table_name
+        self.client = client or boto3.client('dynamodb')
+        self.max_retries = max_retries
+        self.items = []
+
+    def write(self, item, changed=True):
+        self.items.append(item)
+        if len(self.items) >= self.MAX_BATCH:
+            self.flush()
+        return {'StatusCode': 200, 'Message': 'Buffered'}
+
+    def flush(self):
+        while self.items:
+            batch, self.items = self.items[:self.MAX_BATCH], self.items[self.MAX_BATCH:]
+            requests = {self.table_name: [{'PutRequest': {'Item': item}} for item in batch]}
+            for attempt in range(self.max_retries + 1):
+                response = self.client.batch_write_item(RequestItems=requests)
+                requests = response.get('UnprocessedItems') or {}
+                if not requests:
+                    break
+                time.sleep(min(0.05 * 2 ** attempt, 5.0))
+            if requests:
+                raise RuntimeError('{} items were not written to {} after {} retries'.format(
+                    len(requests[self.table_name]), self.table_name, self.max_retries))
+
+    def close(self):
+        self.flush()
+
+
+class FileSink(object):
+    """Append each prediction to a local file as one json line."""
+    def __init__(self, path, changes_only=False):
+        self.path = path
+        self.changes_only = changes_only
+        self.fopen = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, item, changed=True):
+        if self.changes_only and not changed:
+            return {'StatusCode': 200, 'Message': 'Skipped, label unchanged'}
+        with self.lock:
+            self.fopen.write(json.dumps(item) + '\n')
+            self.fopen.flush()
+        return {'StatusCode': 200, 'Message': 'Success'}
+
+    def close(self):
+        self.fopen.close()
+
+
+def save_to_dynamodb(item, table_name, dynamodb=None):
+    """
+    Adds a record to a dynamodb table.
+    Args:
+        item(dict): Record to be added
+        table_name(str): Table name
+        dynamodb: optional boto3 DynamoDB client to reuse
+    Returns:
+        Success/fail response message
+    """
+    dynamodb = dynamodb or boto3.client('dynamodb')
+
+    response = dynamodb.put_item(TableName=table_name, Item=item)
+    status_code = response['ResponseMetadata']['HTTPStatusCode']
+    response = {'StatusCode': status_code}
+    if status_code==200:
+        response['Message'] = 'Success'
+    else:
+        response['Message'] = 'Fail'
+    return response
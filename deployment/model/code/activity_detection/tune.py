@@ -0,0 +1,158 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Measure the throughput of worker x thread splits on this instance.
+
+For every combination of --workers and --threads, that many worker processes are
+placed the way the endpoint places its model server workers (see placement) and
+run the model back to back for --seconds. Each clip is decoded from --video and
+preprocessed, or a random clip is used when no video is given. The report lists
+clips/sec and latency per split. It also lists the cost per 1000 clips when the
+instance price is given. A split whose workers crash, or don't start within
+--timeout, is reported as failed and the next split is tried.
+
+Run it on an instance of each candidate type to choose InstanceType,
+ModelServerWorkers and OmpThreadsPerWorker in cfn_model.yaml. Example, from
+deployment/model/code:
+    python -m activity_detection.tune --model-dir .. --workers 1,2,4,8 --threads 1,2,4 \\
+        --video ~/segment.ts --instance-type ml.c5.4xlarge --price-per-hour 0.952
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+def run_worker(model_dir, slot, workers, threads, seconds, num_frames, video, barrier, results, timeout):
+    #imported in the worker, after the parent set OMP_NUM_THREADS for it
+    import mxnet as mx
+    from .models import load_models
+    from .placement import apply_placement, available_cores, plan_placement
+    from .predict import run_models
+    from .video import read_video_frames
+
+    placement = plan_placement(slot, workers, mx.context.num_gpus(), available_cores(), threads)
+    ctx = apply_placement(placement)
+    name, model = next(iter(load_models(model_dir, ctx=ctx).items()))
+    num_frames = min(num_frames, model['num_frames'] or num_frames)
+    frames = np.random.randint(0, 256, (num_frames, 256, 340, 3), dtype=np.uint8)
+    run_models([(name, model)], [num_frames], frames)
+
+    #raises BrokenBarrierError when another worker crashed or is stuck loading
+    barrier.wait(timeout=timeout)
+    latencies = []
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        tic = time.time()
+        if video:
+            frames = read_video_frames(video, num_frames)
+        run_models([(name, model)], [num_frames], frames)
+        latencies.append(time.time() - tic)
+    results.put({'slot': slot, 'latencies': latencies})
+
+
+def measure(args, workers, threads):
+    """Throughput and latency of one worker x thread split, or the error when it failed."""
+    ctx = mp.get_context('spawn')
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    #spawned workers read OMP_NUM_THREADS when they import mxnet
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    processes = [ctx.Process(target=run_worker, args=(args.model_dir, slot, workers, threads, args.seconds,
+                                                      args.num_frames, args.video, barrier, results, args.timeout))
+                 for slot in range(workers)]
+    for process in processes:
+        process.start()
+    latencies = []
+    received = 0
+    error = None
+    deadline = time.time() + args.timeout + args.seconds
+    while received < workers and error is None:
+        try:
+            latencies += results.get(timeout=1)['latencies']
+            received += 1
+        except queue.Empty:
+            crashed = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+            if crashed:
+                error = 'a worker exited with code {}'.format(crashed[0])
+            elif time.time() > deadline:
+                error = 'no result after {:.0f}s'.format(args.timeout + args.seconds)
+    for process in processes:
+        if error:
+            process.terminate()
+        process.join()
+    if error:
+        return {'workers': workers, 'threads': threads, 'error': error}
+    latencies = np.array(latencies) * 1000
+    report = {
+        'workers': workers,
+        'threads': threads,
+        'clips_per_sec': len(latencies) / float(args.seconds),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+    }
+    if args.price_per_hour:
+        report['usd_per_1000_clips'] = args.price_per_hour / 3.6 / report['clips_per_sec']
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Throughput of worker x thread splits on this instance')
+    parser.add_argument('--model-dir', type=str, required=True, help='directory with the exported model(s)')
+    parser.add_argument('--workers', type=str, default='1,2,4,8', help='worker counts to try')
+    parser.add_argument('--threads', type=str, default='0',
+                        help='threads per worker to try, 0 splits the cores evenly between the workers')
+    parser.add_argument('--seconds', type=float, default=30, help='measurement time per split')
+    parser.add_argument('--num-frames', type=int, default=32)
+    parser.add_argument('--video', type=str, default=None, help='decode this video for every clip')
+    parser.add_argument('--instance-type', type=str, default=None, help='label of this instance in the report')
+    parser.add_argument('--price-per-hour', type=float, default=None, help='instance price to report cost per clip')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds for the workers to load the model, a split that takes longer fails')
+    parser.add_argument('--output', type=str, default='tuning-report.json')
+    parser.add_argument('--oversubscribe', action='store_true', default=False,
+                        help='also try splits with more threads than cores')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    from .placement import available_cores
+    num_cores = len(available_cores())
+
+    reports = []
+    print('{:>8} {:>8} {:>10} {:>9} {:>9} {:>12}'.format('workers', 'threads', 'clips/sec', 'p50 ms', 'p90 ms', 'USD/1k clips'))
+    for workers in [int(x) for x in args.workers.split(',')]:
+        for threads in [int(x) for x in args.threads.split(',')]:
+            threads = threads or max(num_cores // workers, 1)
+            if workers * threads > num_cores and not args.oversubscribe:
+                continue
+            report = measure(args, workers, threads)
+            reports.append(report)
+            if 'error' in report:
+                print('{:>8} {:>8} failed: {}'.format(workers, threads, report['error']))
+                continue
+            print('{:>8} {:>8} {:>10.2f} {:>9.0f} {:>9.0f} {:>12}'.format(
+                workers, threads, report['clips_per_sec'], report['p50_ms'], report['p90_ms'],
+                '{:.4f}'.format(report['usd_per_1000_clips']) if args.price_per_hour else '-'))
+
+    measured = [report for report in reports if 'error' not in report]
+    if not measured:
+        raise SystemExit('every split failed, see the errors above')
+    best = max(measured, key=lambda r: r['clips_per_sec'])
+    with open(args.output, 'w') as fopen:
+        json.dump({'instance_type': args.instance_type, 'cores': num_cores, 'video': args.video,
+                   'num_frames': args.num_frames, 'splits': reports, 'best': best}, fopen, indent=2)
+    print('best: SAGEMAKER_MODEL_SERVER_WORKERS={} OMP_THREADS_PER_WORKER={} ({:.2f} clips/sec), report in {}'.format(
+        best['workers'], best['threads'], best['clips_per_sec'], args.output))
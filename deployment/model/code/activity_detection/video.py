@@ -0,0 +1,258 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Fetch, decode and preprocess video segments for the model."""
+
+from __future__ import print_function
+
+import math
+import os
+import uuid
+
+import boto3
+import cv2
+import numpy as np
+from mxnet import nd
+
+#Preprocessing params, the same as the validation transform used in training
+INPUT_SIZE = 224
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+#hard limits on what one request fetches and decodes
+MAX_VIDEO_BYTES = int(os.environ.get('MAX_VIDEO_BYTES', 512 * 1024 ** 2))
+MAX_VIDEO_SECONDS = float(os.environ.get('MAX_VIDEO_SECONDS', 3600))
+#longer videos are scored in several windows of this length, at most MAX_WINDOWS
+WINDOW_SECONDS = float(os.environ.get('WINDOW_SECONDS', 60))
+MAX_WINDOWS = max(1, int(os.environ.get('MAX_WINDOWS', 8)))
+#videos over MAX_VIDEO_BYTES are read in ranges of this size around each window, MPEG-TS only
+RANGE_READ_BYTES = int(os.environ.get('RANGE_READ_BYTES', 32 * 1024 ** 2))
+RANGED_EXTENSIONS = ('.ts',)
+#decoder threads, 0 lets decord decide, set per worker by the placement
+DECODE_THREADS = 0
+TS_PACKET_SIZE = 188
+
+_S3_CLIENT = None
+
+
+def get_s3_client():
+    """One S3 client per process, created on first use."""
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        _S3_CLIENT = boto3.client('s3')
+    return _S3_CLIENT
+
+
+def get_bucket_and_key(s3_path):
+    """Get the bucket name and key from the given path.
+    Args:
+        s3_path(str): Input S3 path
+    """
+    s3_path = s3_path.replace('s3://', '')
+    s3_path = s3_path.replace('S3://', '') #Both cases
+    bucket, key = s3_path.split('/', 1)
+    return bucket, key
+
+
+def is_s3_path(path):
+    return path.lower().startswith('s3://')
+
+
+class VideoLimitExceeded(ValueError):
+    """The video is over the size or duration limit."""
+
+
+def object_size(video_path):
+    """Size in bytes of an S3 or local video."""
+    if not is_s3_path(video_path):
+        return os.path.getsize(video_path)
+    bucket, key = get_bucket_and_key(video_path)
+    return get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+
+
+def fetch_video(video_path, byte_range=None):
+    """Copy the video, or the [start, end) byte range of it, to a unique file under /tmp.
+
+    Returns the local path and whether it is a temporary copy the caller removes.
+    A whole local video (no s3:// scheme) is read in place.
+    """
+    if not is_s3_path(video_path) and byte_range is None:
+        return os.path.abspath(video_path), False
+    download_path = '/tmp/{}-{}'.format(uuid.uuid4(), os.path.basename(video_path))
+    if is_s3_path(video_path):
+        bucket, key = get_bucket_and_key(video_path)
+        if byte_range is None:
+            get_s3_client().download_file(bucket, key, download_path)
+            return download_path, True
+        response = get_s3_client().get_object(Bucket=bucket, Key=key,
+                                              Range='bytes={}-{}'.format(byte_range[0], byte_range[1] - 1))
+        chunks = response['Body'].iter_chunks(1024 ** 2)
+    else:
+        chunks = _file_chunks(video_path, byte_range[0], byte_range[1])
+    with open(download_path, 'wb') as fout:
+        for chunk in chunks:
+            fout.write(chunk)
+    return download_path, True
+
+
+def _file_chunks(path, start, end, chunk_size=1024 ** 2):
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = fin.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def sample_center_indices(duration, num_frames):
+    """Frame ids of the centered clip of num_frames consecutive frames.
+
+    Same sampling as VideoClsCustom's test indices with one segment and a step of
+    one: near the end of a short video the last frame is repeated.
+    """
+    if duration > num_frames - 1:
+        offset = int((duration - num_frames + 1) / 2.0) + 1
+    else:
+        offset = 1
+    indices = []
+    for _ in range(num_frames):
+        indices.append(offset - 1)
+        if offset + 1 < duration:
+            offset += 1
+    return indices
+
+
+def window_indices(duration, fps, num_frames=32, max_windows=1):
+    """Frame ids of the centered clip of each window of a video.
+
+    A video up to WINDOW_SECONDS long is one window (the centered clip of the
+    whole video), longer ones are split in equal windows, at most max_windows.
+    """
+    num_windows = 1
+    if fps > 0 and duration / fps > WINDOW_SECONDS:
+        num_windows = max(min(int(math.ceil(duration / fps / WINDOW_SECONDS)), max_windows), 1)
+    windows = []
+    for i in range(num_windows):
+        start, end = duration * i // num_windows, duration * (i + 1) // num_windows
+        windows.append([start + j for j in sample_center_indices(end - start, num_frames)])
+    return windows
+
+
+def window_byte_ranges(size, num_windows, range_bytes=RANGE_READ_BYTES):
+    """A byte range centered in each of num_windows equal parts of the object, aligned to TS packets."""
+    ranges = []
+    for i in range(num_windows):
+        center = size * (2 * i + 1) // (2 * num_windows)
+        start = max(center - range_bytes // 2, 0) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        ranges.append((start, min(start + range_bytes, size)))
+    return ranges
+
+
+def check_duration(video_path, seconds):
+    if seconds > MAX_VIDEO_SECONDS:
+        raise VideoLimitExceeded('{} is {:.0f}s long, over the limit of {:.0f}s'.format(
+            video_path, seconds, MAX_VIDEO_SECONDS))
+
+
+def read_video_windows(video_path, num_frames=32, max_windows=1):
+    """Fetch the video (S3 or local) and yield the decoded frames of each window in turn.
+
+    Only one window is held in memory at a time. A video over MAX_VIDEO_BYTES is
+    read in ranges of RANGE_READ_BYTES around max_windows evenly spaced windows
+    when it is MPEG-TS, which can be decoded from any packet boundary; other
+    containers need their index and are rejected. Videos over MAX_VIDEO_SECONDS
+    are rejected.
+    """
+    import decord
+    size = object_size(video_path)
+    if size > MAX_VIDEO_BYTES:
+        if not video_path.lower().endswith(RANGED_EXTENSIONS):
+            raise VideoLimitExceeded('{} is {} bytes, over the limit of {} bytes'.format(
+                video_path, size, MAX_VIDEO_BYTES))
+        for byte_range in window_byte_ranges(size, max_windows):
+            local_path, _ = fetch_video(video_path, byte_range)
+            try:
+                video_reader = decord.VideoReader(local_path, num_threads=DECODE_THREADS)
+                duration = len(video_reader)
+                #the bitrate of the range gives an estimate of the length of the whole video
+                check_duration(video_path, duration / max(video_reader.get_avg_fps(), 1e-6)
+                               * size / float(byte_range[1] - byte_range[0]))
+                frames = video_reader.get_batch(sample_center_indices(duration, num_frames)).asnumpy()
+                del video_reader
+            finally:
+                os.remove(local_path)
+            yield frames
+        return
+
+    local_path, is_temporary = fetch_video(video_path)
+    try:
+        video_reader = decord.VideoReader(local_path, num_threads=DECODE_THREADS)
+        duration, fps = len(video_reader), video_reader.get_avg_fps()
+        check_duration(video_path, duration / max(fps, 1e-6))
+        for indices in window_indices(duration, fps, num_frames, max_windows):
+            yield video_reader.get_batch(indices).asnumpy()
+    finally:
+        if is_temporary:
+            os.remove(local_path)
+
+
+def read_video_frames(video_path, num_frames=32):
+    """Fetch the video (S3 or local) and decode the sampled frames of its centered clip."""
+    windows = read_video_windows(video_path, num_frames, max_windows=1)
+    try:
+        return next(windows)
+    finally:
+        windows.close()
+
+
+def crop_frames(frames, size=INPUT_SIZE):
+    """Center crop the (frames, height, width, 3) decoded frames to size x size."""
+    frames = np.asarray(frames)
+    height, width = frames.shape[1:3]
+    y1 = int(round((height - size) / 2.))
+    x1 = int(round((width - size) / 2.))
+    return frames[:, y1:y1 + size, x1:x1 + size, :]
+
+
+def normalize_clips(clips):
+    """Normalize a (batch, frames, height, width, 3) uint8 array into the (batch, 3, frames, height, width) input."""
+    clips = np.asarray(clips, dtype=np.float32)
+    clips = (clips / 255.0 - MEAN) / STD
+    return clips.transpose((0, 4, 1, 2, 3))
+
+
+def preprocess_frames(frames, num_frames=32):
+    """Center crop and normalize the decoded frames into a (1, 3, num_frames, 224, 224) clip.
+
+    Vectorized equivalent of gluoncv's VideoGroupValTransform on the whole clip.
+    """
+    clip = normalize_clips(crop_frames(frames)[np.newaxis])
+    if num_frames == 1:
+        clip = np.squeeze(clip, axis=2)    # this is for 2D input case
+    return nd.array(clip)
+
+
+def read_video_data(video_path, num_frames=32):
+    """Read and preprocess video data from the S3 bucket (or a local path)."""
+    return preprocess_frames(read_video_frames(video_path, num_frames), num_frames)
+
+
+def subsample_frames(clip_input, num_frames):
+    """Evenly pick num_frames of the (batch, channel, frames, height, width) clip."""
+    total = clip_input.shape[2]
+    if num_frames >= total:
+        return clip_input
+    indices = np.linspace(0, total - 1, num_frames).round()
+    return nd.take(clip_input, nd.array(indices, ctx=clip_input.context), axis=2)
+
+
+def motion_score(frames, size=64):
+    """Mean absolute difference of consecutive frames on small grayscale copies, in [0, 1]."""
+    gray = [cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), (size, size),
+                       interpolation=cv2.INTER_AREA).astype(np.float32) for frame in frames]
+    if len(gray) < 2:
+        return 0.0
+    diffs = [np.abs(curr - prev).mean() for prev, curr in zip(gray[:-1], gray[1:])]
+    return float(np.mean(diffs)) / 255.0
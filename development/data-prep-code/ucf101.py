@@ -14,12 +14,36 @@ import os.path as osp
 import glob
 import fnmatch
 import random
+import json
+import time
+import traceback
 import zipfile
 from pipes import quote
 from multiprocessing import Pool, current_process
 
+def get_output_size(width, height):
+    """Frame size after applying --new_width/--new_height or --short_side."""
+    if args.new_width > 0 and args.new_height > 0:
+        return args.new_width, args.new_height
+    if args.short_side > 0 and min(width, height) > args.short_side:
+        scale = float(args.short_side) / min(width, height)
+        return int(round(width * scale)), int(round(height * scale))
+    return width, height
+
+
+def probe_video_size(full_path):
+    """Width and height of a video, read from its header with OpenCV."""
+    import cv2
+
+    cap = cv2.VideoCapture(full_path)
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return size
+
+
 def dump_frames(vid_item):
 
+    import cv2
     from gluoncv.utils.filesystem import try_import_mmcv
     mmcv = try_import_mmcv()
 
@@ -30,18 +54,74 @@ def dump_frames(vid_item):
         os.mkdir(out_full_path)
     except OSError:
         pass
+    tic = time.time()
     vr = mmcv.VideoReader(full_path)
+    out_size = get_output_size(vr.width, vr.height)
+    resize = out_size != (vr.width, vr.height)
+    jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality]
+    # keep every frame unless a lower target fps is requested
+    step = 1.0
+    if args.target_fps > 0 and vr.fps > args.target_fps:
+        step = vr.fps / args.target_fps
+
+    num_written = 0
+    bytes_written = 0
+    full_frame_bytes = 0
+    next_keep = 0.0
     for i in range(len(vr)):
-        if vr[i] is not None:
-            mmcv.imwrite(
-                vr[i], '{}/img_{:05d}.jpg'.format(out_full_path, i + 1))
-        else:
+        frame = vr[i]
+        if frame is None:
             print('[Warning] length inconsistent!'
                   'Early stop with {} out of {} frames'.format(i + 1, len(vr)))
             break
-    print('{} done with {} frames'.format(vid_name, len(vr)))
+        if i < int(next_keep):
+            continue
+        next_keep += step
+        if num_written == 0:
+            # size of a full-resolution frame, used to estimate the saving
+            full_frame_bytes = len(cv2.imencode('.jpg', frame)[1])
+        if resize:
+            frame = mmcv.imresize(frame, out_size, interpolation='area')
+        num_written += 1
+        frame_path = '{}/img_{:05d}.jpg'.format(out_full_path, num_written)
+        mmcv.imwrite(frame, frame_path, params=jpeg_params)
+        bytes_written += os.path.getsize(frame_path)
+    elapsed = time.time() - tic
+    print('{} done with {} out of {} frames at {}x{} in {:.2f}s'.format(
+        vid_name, num_written, len(vr), out_size[0], out_size[1], elapsed))
+    sys.stdout.flush()
+    return num_written, elapsed, bytes_written, full_frame_bytes * len(vr)
+
+
+def report_frame_stats(results, wall_time):
+    """Print disk usage and decode time of the extracted RGB frames."""
+    results = [r for r in results if r[0] > 0]
+    if not results:
+        return
+    total_frames = sum(r[0] for r in results)
+    written = sum(r[2] for r in results)
+    full = sum(r[3] for r in results)
+    decode_times = sorted(r[1] for r in results)
+    print('Frame extraction: {} frames from {} videos in {:.1f}s'.format(
+        total_frames, len(results), wall_time))
+    print('  disk: {:.1f} MB written, ~{:.1f} MB at full resolution and fps '
+          '({:.1f}% reduction)'.format(written / 1e6, full / 1e6,
+                                       100.0 * (1 - float(written) / full) if full else 0.0))
+    print('  per-video decode time: mean {:.2f}s, median {:.2f}s, max {:.2f}s'.format(
+        sum(decode_times) / len(decode_times),
+        decode_times[len(decode_times) // 2], decode_times[-1]))
     sys.stdout.flush()
-    return True
+
+
+def count_flow_frames(out_full_path):
+    if args.out_format == 'zip':
+        #dense_flow packs every flow_x frame into flow_x.zip
+        zip_path = osp.join(out_full_path, 'flow_x.zip')
+        if not osp.exists(zip_path):
+            return 0
+        with zipfile.ZipFile(zip_path) as zf:
+            return len(zf.namelist())
+    return len(fnmatch.filter(os.listdir(out_full_path), args.flow_x_prefix + '*'))
 
 
 def run_optical_flow(vid_item, dev_id=0):
@@ -53,23 +133,29 @@ def run_optical_flow(vid_item, dev_id=0):
     except OSError:
         pass
 
+    tic = time.time()
     current = current_process()
     dev_id = (int(current._identity[0]) - 1) % args.num_gpu
     image_path = '{}/img'.format(out_full_path)
     flow_x_path = '{}/flow_x'.format(out_full_path)
     flow_y_path = '{}/flow_y'.format(out_full_path)
+    new_width, new_height = args.new_width, args.new_height
+    if args.short_side > 0:
+        #dense_flow only takes a fixed size, work it out from the video like the CPU path does
+        new_width, new_height = get_output_size(*probe_video_size(full_path))
 
     cmd = osp.join(args.df_path, 'build/extract_gpu') + \
         ' -f={} -x={} -y={} -i={} -b=20 -t=1 -d={} -s=1 -o={} -w={} -h={}' \
         .format(
         quote(full_path),
         quote(flow_x_path), quote(flow_y_path), quote(image_path),
-        dev_id, args.out_format, args.new_width, args.new_height)
+        dev_id, args.out_format, new_width, new_height)
 
-    os.system(cmd)
+    if os.system(cmd) != 0:
+        raise RuntimeError('dense_flow failed: {}'.format(cmd))
     print('{} {} done'.format(vid_id, vid_name))
     sys.stdout.flush()
-    return True
+    return count_flow_frames(out_full_path), time.time() - tic
 
 
 def run_warp_optical_flow(vid_item, dev_id=0):
@@ -81,6 +167,7 @@ def run_warp_optical_flow(vid_item, dev_id=0):
     except OSError:
         pass
 
+    tic = time.time()
     current = current_process()
     dev_id = (int(current._identity[0]) - 1) % args.num_gpu
     flow_x_path = '{}/flow_x'.format(out_full_path)
@@ -91,10 +178,240 @@ def run_warp_optical_flow(vid_item, dev_id=0):
             quote(full_path), quote(flow_x_path), quote(flow_y_path),
             dev_id, args.out_format)
 
-    os.system(cmd)
+    if os.system(cmd) != 0:
+        raise RuntimeError('dense_flow failed: {}'.format(cmd))
     print('warp on {} {} done'.format(vid_id, vid_name))
     sys.stdout.flush()
-    return True
+    return count_flow_frames(out_full_path), time.time() - tic
+
+
+def init_cpu_flow_worker(threads_per_worker):
+    """Pin a CPU flow worker to its own slice of cores.
+
+    Each pool process gets ``threads_per_worker`` cores, assigned round robin
+    from the cores available to the parent, and OpenCV/OpenMP are limited to
+    the same number of threads so workers do not oversubscribe the machine.
+    """
+    import cv2
+
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_worker)
+    cv2.setNumThreads(threads_per_worker)
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        worker_id = int(current_process()._identity[0]) - 1
+        start = (worker_id * threads_per_worker) % len(cores)
+        pinned = [cores[(start + j) % len(cores)] for j in range(threads_per_worker)]
+        os.sched_setaffinity(0, pinned)
+
+
+def create_cpu_flow(algo):
+    """Create an OpenCV dense optical flow estimator for the CPU backend."""
+    import cv2
+
+    if algo == 'farneback':
+        return lambda prev, curr: cv2.calcOpticalFlowFarneback(
+            prev, curr, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    # TV-L1 lives in opencv-contrib (cv2.optflow) on OpenCV >= 4
+    if hasattr(cv2, 'optflow'):
+        tvl1 = cv2.optflow.DualTVL1OpticalFlow_create()
+    elif hasattr(cv2, 'DualTVL1OpticalFlow_create'):
+        tvl1 = cv2.DualTVL1OpticalFlow_create()
+    else:
+        raise RuntimeError('TV-L1 flow needs opencv-contrib-python, '
+                           'use --cpu_flow_algo farneback instead')
+    return lambda prev, curr: tvl1.calc(prev, curr, None)
+
+
+def warp_previous_frame(prev, curr):
+    """Compensate camera motion by warping ``prev`` onto ``curr`` with a homography."""
+    import cv2
+    import numpy as np
+
+    orb = cv2.ORB_create(1000)
+    kp_prev, des_prev = orb.detectAndCompute(prev, None)
+    kp_curr, des_curr = orb.detectAndCompute(curr, None)
+    if des_prev is None or des_curr is None:
+        return prev
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(des_prev, des_curr)
+    if len(matches) < 4:
+        return prev
+    src = np.float32([kp_prev[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
+    dst = np.float32([kp_curr[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+    homography, _ = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+    if homography is None:
+        return prev
+    return cv2.warpPerspective(prev, homography, (curr.shape[1], curr.shape[0]))
+
+
+def flow_to_image(flow, bound=20):
+    """Quantize a flow component to uint8 the same way dense_flow does."""
+    import numpy as np
+
+    flow = np.clip(flow, -bound, bound)
+    return np.round((flow + bound) * (255.0 / (2 * bound))).astype(np.uint8)
+
+
+def write_flow_jpg(out_full_path, archives, kind, idx, image):
+    """Write one img/flow_x/flow_y frame as a jpg, into <kind>.zip when archives are open."""
+    import cv2
+
+    if archives is None:
+        cv2.imwrite('{}/{}_{:05d}.jpg'.format(out_full_path, kind, idx), image)
+    else:
+        #dense_flow names the zip entries img_, x_ and y_
+        entry = '{}_{:05d}.jpg'.format(kind.replace('flow_', ''), idx)
+        archives[kind].writestr(entry, cv2.imencode('.jpg', image)[1].tobytes())
+
+
+def run_cpu_optical_flow(vid_item, warp=False):
+    """CPU replacement for run_optical_flow / run_warp_optical_flow.
+
+    Writes img_/flow_x_/flow_y_ jpgs (or img.zip/flow_x.zip/flow_y.zip with
+    --out_format zip) with the same names dense_flow uses so that
+    parse_directory and count_flow_frames count them unchanged. Frames are
+    resized like the RGB frames of dump_frames. Returns the number of flow
+    frames and the time spent so decode_video can report throughput.
+    """
+    import cv2
+
+    full_path, vid_path, vid_id = vid_item
+    vid_name = vid_path.split('.')[0]
+    out_full_path = osp.join(args.out_dir, vid_name)
+    try:
+        os.mkdir(out_full_path)
+    except OSError:
+        pass
+
+    tic = time.time()
+    calc_flow = create_cpu_flow(args.cpu_flow_algo)
+    archives = None
+    if args.out_format == 'zip':
+        #the frames are already jpeg compressed, store them as they are
+        kinds = ('flow_x', 'flow_y') if warp else ('img', 'flow_x', 'flow_y')
+        archives = dict((kind, zipfile.ZipFile('{}/{}.zip'.format(out_full_path, kind), 'w', zipfile.ZIP_STORED))
+                        for kind in kinds)
+    cap = cv2.VideoCapture(full_path)
+    prev_gray = None
+    num_flow = 0
+    idx = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        out_size = get_output_size(frame.shape[1], frame.shape[0])
+        if out_size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, out_size, interpolation=cv2.INTER_AREA)
+        idx += 1
+        if not warp:
+            write_flow_jpg(out_full_path, archives, 'img', idx, frame)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if prev_gray is not None:
+            prev = warp_previous_frame(prev_gray, gray) if warp else prev_gray
+            flow = calc_flow(prev, gray)
+            num_flow += 1
+            write_flow_jpg(out_full_path, archives, 'flow_x', num_flow, flow_to_image(flow[..., 0]))
+            write_flow_jpg(out_full_path, archives, 'flow_y', num_flow, flow_to_image(flow[..., 1]))
+        prev_gray = gray
+    cap.release()
+    if archives is not None:
+        for archive in archives.values():
+            archive.close()
+
+    elapsed = time.time() - tic
+    print('{}{} {} done with {} flow frames in {:.1f}s'.format(
+        'warp on ' if warp else '', vid_id, vid_name, num_flow, elapsed))
+    sys.stdout.flush()
+    return num_flow, elapsed
+
+
+def run_cpu_warp_optical_flow(vid_item):
+    return run_cpu_optical_flow(vid_item, warp=True)
+
+
+def report_flow_throughput(results, wall_time, num_worker, threads_per_worker):
+    """Print frames/sec overall and per core for sizing CPU prep jobs."""
+    total_frames = sum(r[0] for r in results)
+    busy_time = sum(r[1] for r in results)
+    num_cores = num_worker * threads_per_worker
+    fps = total_frames / wall_time if wall_time > 0 else 0.0
+    print('Optical flow throughput: {} frames from {} videos in {:.1f}s'.format(
+        total_frames, len(results), wall_time))
+    print('  {:.2f} frames/sec total, {:.2f} frames/sec per core ({} workers x {} threads)'.format(
+        fps, fps / num_cores, num_worker, threads_per_worker))
+    if busy_time > 0:
+        print('  {:.2f} frames/sec per worker while busy'.format(total_frames / busy_time))
+    sys.stdout.flush()
+
+
+def run_task(task):
+    """Run one prep task, capturing the error instead of aborting the pool.
+
+    Every worker returns a tuple starting with (num_frames, elapsed).
+    """
+    worker, vid_item = task
+    try:
+        return vid_item, worker(vid_item), None
+    except Exception:
+        return vid_item, None, traceback.format_exc()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+
+
+def run_pool(pool, worker, vid_items, chunksize=4, report_every=10.0):
+    """Process videos unordered and in chunks, printing live progress.
+
+    Returns the worker results of the successful videos and a list of
+    (vid_item, traceback) for the failed ones.
+    """
+    total = len(vid_items)
+    results, failures = [], []
+    num_frames = 0
+    tic = last_report = time.time()
+    tasks = ((worker, vid_item) for vid_item in vid_items)
+    for done, (vid_item, result, error) in enumerate(
+            pool.imap_unordered(run_task, tasks, chunksize=chunksize), 1):
+        if error is None:
+            results.append(result)
+            num_frames += result[0]
+        else:
+            failures.append((vid_item, error))
+            print('[Error] {} failed:\n{}'.format(vid_item[0], error))
+        now = time.time()
+        if now - last_report >= report_every or done == total:
+            last_report = now
+            elapsed = now - tic
+            eta = elapsed / done * (total - done)
+            print('[{}/{}] {:.1f}% | {:.1f} videos/s | {:.1f} frames/s | '
+                  'failed {} | elapsed {} | ETA {}'.format(
+                      done, total, 100.0 * done / total, done / elapsed,
+                      num_frames / elapsed, len(failures),
+                      format_duration(elapsed), format_duration(eta)))
+            sys.stdout.flush()
+    wall_time = time.time() - tic
+    print('Processed {} videos ({} failed), {} frames in {} ({:.1f} frames/s)'.format(
+        total, len(failures), num_frames, format_duration(wall_time),
+        num_frames / wall_time if wall_time > 0 else 0.0))
+    return results, failures, wall_time
+
+
+def write_failure_manifest(failures, manifest_path):
+    """Write failed videos as json lines that --retry_failed can read back."""
+    with open(manifest_path, 'w') as f:
+        for (full_path, vid_path, _), error in failures:
+            f.write(json.dumps({'full_path': full_path, 'vid_path': vid_path,
+                                'error': error.strip().splitlines()[-1]}) + '\n')
+    print('{} failed videos written to {}, rerun with --retry_failed {}'.format(
+        len(failures), manifest_path, manifest_path))
+
+
+def read_failure_manifest(manifest_path):
+    with open(manifest_path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    return [x['full_path'] for x in items], [x['vid_path'] for x in items]
 
 
 def parse_args():
@@ -109,12 +426,21 @@ def parse_args():
     parser.add_argument('--num_worker', type=int, default=8)
     parser.add_argument('--flow_type', type=str, default=None, choices=[None, 'tvl1', 'warp_tvl1'])
     parser.add_argument('--df_path', type=str, default='./dense_flow', help='need dense flow implementation')
+    parser.add_argument('--flow_backend', type=str, default='gpu', choices=['gpu', 'cpu'], help='dense_flow GPU build or OpenCV on CPU')
+    parser.add_argument('--cpu_flow_algo', type=str, default='tvl1', choices=['tvl1', 'farneback'], help='flow algorithm for the CPU backend')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='cores pinned to each CPU flow worker')
     parser.add_argument("--out_format", type=str, default='dir', choices=['dir', 'zip'], help='output format')
     parser.add_argument("--ext", type=str, default='avi', choices=['avi', 'mp4'], help='video file extensions')
     parser.add_argument("--new_width", type=int, default=0, help='resize image width')
     parser.add_argument("--new_height", type=int, default=0, help='resize image height')
+    parser.add_argument("--short_side", type=int, default=0, help='resize RGB and optical flow frames so the short side is at most this size')
+    parser.add_argument("--target_fps", type=float, default=0, help='subsample RGB frames to this frame rate')
+    parser.add_argument("--jpeg_quality", type=int, default=95, help='JPEG quality of the extracted RGB frames')
     parser.add_argument("--num_gpu", type=int, default=8, help='number of GPU')
     parser.add_argument("--resume", action='store_true', default=False, help='resume optical flow extraction instead of overwriting')
+    parser.add_argument("--chunksize", type=int, default=4, help='videos handed to a worker at a time')
+    parser.add_argument("--failure_manifest", type=str, default=None, help='where to list failed videos, defaults to <out_dir>_failed_videos.jsonl')
+    parser.add_argument("--retry_failed", type=str, default=None, help='only process the videos listed in this failure manifest')
     parser.add_argument('--dataset', type=str, choices=['ucf101', 'kinetics400'], default='ucf101')
     parser.add_argument('--rgb_prefix', type=str, default='img_')
     parser.add_argument('--flow_x_prefix', type=str, default='flow_x_')
@@ -151,36 +477,65 @@ def decode_video(args):
                 print('Creating folder: {}'.format(new_dir))
                 os.makedirs(new_dir)
 
-    print('Reading videos from folder: ', args.src_dir)
-    print('Extension of videos: ', args.ext)
-    if args.level == 2:
-        fullpath_list = glob.glob(args.src_dir + '/*/*.' + args.ext)
-        done_fullpath_list = glob.glob(args.out_dir + '/*/*')
-    elif args.level == 1:
-        fullpath_list = glob.glob(args.src_dir + '/*.' + args.ext)
-        done_fullpath_list = glob.glob(args.out_dir + '/*')
-    print('Total number of videos found: ', len(fullpath_list))
-    if args.resume:
-        fullpath_list = set(fullpath_list).difference(set(done_fullpath_list))
-        fullpath_list = list(fullpath_list)
-        print('Resuming. number of videos to be done: ', len(fullpath_list))
-
-    if args.level == 2:
-        vid_list = list(map(lambda p: osp.join(
-            '/'.join(p.split('/')[-2:])), fullpath_list))
-    elif args.level == 1:
-        vid_list = list(map(lambda p: p.split('/')[-1], fullpath_list))
-
-    pool = Pool(args.num_worker)
-    if args.flow_type == 'tvl1':
-        pool.map(run_optical_flow, zip(
-            fullpath_list, vid_list, range(len(vid_list))))
-    elif args.flow_type == 'warp_tvl1':
-        pool.map(run_warp_optical_flow, zip(
-            fullpath_list, vid_list, range(len(vid_list))))
+    if args.retry_failed:
+        fullpath_list, vid_list = read_failure_manifest(args.retry_failed)
+        print('Retrying {} failed videos from {}'.format(len(fullpath_list), args.retry_failed))
+    else:
+        print('Reading videos from folder: ', args.src_dir)
+        print('Extension of videos: ', args.ext)
+        if args.level == 2:
+            fullpath_list = glob.glob(args.src_dir + '/*/*.' + args.ext)
+            done_fullpath_list = glob.glob(args.out_dir + '/*/*')
+        elif args.level == 1:
+            fullpath_list = glob.glob(args.src_dir + '/*.' + args.ext)
+            done_fullpath_list = glob.glob(args.out_dir + '/*')
+        print('Total number of videos found: ', len(fullpath_list))
+        if args.resume:
+            fullpath_list = set(fullpath_list).difference(set(done_fullpath_list))
+            fullpath_list = list(fullpath_list)
+            print('Resuming. number of videos to be done: ', len(fullpath_list))
+
+        if args.level == 2:
+            vid_list = list(map(lambda p: osp.join(
+                '/'.join(p.split('/')[-2:])), fullpath_list))
+        elif args.level == 1:
+            vid_list = list(map(lambda p: p.split('/')[-1], fullpath_list))
+
+    if not fullpath_list:
+        print('No videos to process.')
+        return
+    vid_items = list(zip(fullpath_list, vid_list, range(len(vid_list))))
+
+    cpu_flow = args.flow_type is not None and args.flow_backend == 'cpu'
+    if cpu_flow:
+        pool = Pool(args.num_worker, initializer=init_cpu_flow_worker,
+                    initargs=(args.threads_per_worker,))
+        worker = run_cpu_optical_flow if args.flow_type == 'tvl1' else run_cpu_warp_optical_flow
     else:
-        pool.map(dump_frames, zip(
-            fullpath_list, vid_list, range(len(vid_list))))
+        pool = Pool(args.num_worker)
+        if args.flow_type == 'tvl1':
+            worker = run_optical_flow
+        elif args.flow_type == 'warp_tvl1':
+            worker = run_warp_optical_flow
+        else:
+            worker = dump_frames
+
+    results, failures, wall_time = run_pool(pool, worker, vid_items,
+                                            chunksize=args.chunksize)
+    pool.close()
+    pool.join()
+
+    if cpu_flow:
+        report_flow_throughput(results, wall_time,
+                               args.num_worker, args.threads_per_worker)
+    elif args.flow_type is None:
+        report_frame_stats(results, wall_time)
+
+    manifest_path = args.failure_manifest or args.out_dir.rstrip('/') + '_failed_videos.jsonl'
+    if failures:
+        write_failure_manifest(failures, manifest_path)
+    elif osp.exists(manifest_path):
+        os.remove(manifest_path)
 
 def parse_ucf101_splits(args):
     level = args.level
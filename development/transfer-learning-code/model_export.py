@@ -0,0 +1,257 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Serving-optimized variants of the exported training graph.
+
+`export_variants` starts from the `model-symbol.json`/`model-0000.params` pair written
+by `net.export` and adds:
+
+* fused: every BatchNorm that directly follows a Convolution is folded into the
+  convolution weights and bias, so inference runs one op instead of two.
+* pruned (optional): the filters with the smallest L1 norm are removed from
+  Convolution -> ReLU -> Convolution chains (the inner convolutions of the
+  bottleneck blocks), shrinking both convolutions.
+
+Each variant is evaluated at every requested clip length and its CPU latency is
+measured. The results are written to `variants.json`, which the endpoint's
+`model_fn` reads to pick the variant to serve.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import numpy as np
+import mxnet as mx
+from mxnet import gluon, nd
+
+MANIFEST_NAME = 'variants.json'
+
+
+def load_exported(prefix):
+    """Load the symbol graph (as parsed json) and the params written by `net.export`."""
+    with open('%s-symbol.json' % prefix) as fopen:
+        graph = json.load(fopen)
+    arg_params, aux_params = {}, {}
+    for name, value in nd.load('%s-0000.params' % prefix).items():
+        kind, name = name.split(':', 1)
+        if kind == 'arg':
+            arg_params[name] = value.asnumpy()
+        else:
+            aux_params[name] = value.asnumpy()
+    return graph, arg_params, aux_params
+
+
+def save_exported(prefix, graph, arg_params, aux_params):
+    """Write a graph and its params in the `net.export` format, dropping unused params."""
+    used = set(node['name'] for node in graph['nodes'] if node['op'] == 'null')
+    params = {'arg:%s' % k: nd.array(v, dtype=v.dtype) for k, v in arg_params.items() if k in used}
+    params.update({'aux:%s' % k: nd.array(v, dtype=v.dtype) for k, v in aux_params.items() if k in used})
+    with open('%s-symbol.json' % prefix, 'w') as fopen:
+        json.dump(graph, fopen, indent=2)
+    nd.save('%s-0000.params' % prefix, params)
+
+
+def _to_objects(graph):
+    # replace node indices with references so nodes can be dropped and added freely
+    nodes = [dict(node, attrs=dict(node.get('attrs', {}))) for node in graph['nodes']]
+    for node in nodes:
+        node['inputs'] = [[nodes[e[0]], e[1]] for e in node['inputs']]
+    heads = [[nodes[e[0]], e[1]] for e in graph['heads']]
+    return nodes, heads
+
+
+def _to_graph(graph, heads):
+    # serialize the nodes reachable from the heads in topological order
+    order, index = [], {}
+    for head in heads:
+        stack = [(head[0], False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in index:
+                continue
+            if expanded:
+                index[id(node)] = len(order)
+                order.append(node)
+                continue
+            stack.append((node, True))
+            for entry in reversed(node['inputs']):
+                if id(entry[0]) not in index:
+                    stack.append((entry[0], False))
+    nodes = []
+    for node in order:
+        node = dict(node, inputs=[[index[id(e[0])], e[1], 0] for e in node['inputs']])
+        if not node['attrs']:
+            del node['attrs']
+        nodes.append(node)
+    result = {
+        'nodes': nodes,
+        'arg_nodes': [i for i, node in enumerate(nodes) if node['op'] == 'null'],
+        'heads': [[index[id(e[0])], e[1], 0] for e in heads],
+    }
+    if 'attrs' in graph:
+        result['attrs'] = graph['attrs']
+    return result
+
+
+def _consumers(nodes, heads):
+    consumers = dict((id(node), []) for node in nodes)
+    for node in nodes:
+        for entry in node['inputs']:
+            consumers[id(entry[0])].append((node, entry[1]))
+    for entry in heads:
+        consumers[id(entry[0])].append((None, entry[1]))
+    return consumers
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def fold_batchnorm(graph, arg_params, aux_params):
+    """Fold BatchNorm into the preceding Convolution. Returns the new graph and params."""
+    nodes, heads = _to_objects(graph)
+    consumers = _consumers(nodes, heads)
+    arg_params, aux_params = dict(arg_params), dict(aux_params)
+    folded = {}
+    for bn in nodes:
+        if bn['op'] != 'BatchNorm':
+            continue
+        conv = bn['inputs'][0][0]
+        weight = conv['inputs'][1][0] if conv['op'] == 'Convolution' else None
+        if (weight is None or len(consumers[id(conv)]) != 1 or weight['name'] not in arg_params
+                or any(idx != 0 for _, idx in consumers[id(bn)])):
+            continue
+        gamma, beta, mean, var = [bn['inputs'][k][0]['name'] for k in range(1, 5)]
+        eps = float(bn['attrs'].get('eps', 1e-3))
+        scale = 1.0 / np.sqrt(aux_params[var] + eps)
+        if not _is_true(bn['attrs'].get('fix_gamma', 'True')):
+            scale = scale * arg_params[gamma]
+        w = arg_params[weight['name']]
+        arg_params[weight['name']] = (w * scale.reshape((-1,) + (1,) * (w.ndim - 1))).astype(w.dtype)
+        if _is_true(conv['attrs'].get('no_bias', 'False')):
+            bias = {'op': 'null', 'name': conv['name'] + '_bias', 'attrs': {}, 'inputs': []}
+            conv['inputs'].append([bias, 0])
+            conv['attrs']['no_bias'] = 'False'
+            b = np.zeros_like(aux_params[mean])
+        else:
+            bias = conv['inputs'][2][0]
+            b = arg_params[bias['name']]
+        arg_params[bias['name']] = ((b - aux_params[mean]) * scale + arg_params[beta]).astype(w.dtype)
+        folded[id(bn)] = conv
+    for node in nodes:
+        node['inputs'] = [[folded[id(e[0])], 0] if id(e[0]) in folded else e for e in node['inputs']]
+    heads = [[folded[id(e[0])], 0] if id(e[0]) in folded else e for e in heads]
+    print('folded %d BatchNorm layers into convolutions' % len(folded))
+    return _to_graph(graph, heads), arg_params, aux_params
+
+
+def prune_channels(graph, arg_params, aux_params, ratio):
+    """Remove `ratio` of the filters of every Convolution -> ReLU -> Convolution chain.
+
+    Filters are ranked by L1 norm. Expects a BatchNorm-folded graph, since a
+    BatchNorm between the two convolutions would also need slicing.
+    """
+    nodes, heads = _to_objects(graph)
+    consumers = _consumers(nodes, heads)
+    arg_params = dict(arg_params)
+    pruned = 0
+    for conv in nodes:
+        if conv['op'] != 'Convolution' or int(conv['attrs'].get('num_group', 1)) != 1:
+            continue
+        act = consumers[id(conv)][0][0] if len(consumers[id(conv)]) == 1 else None
+        if act is None or act['op'] != 'Activation' or act['attrs'].get('act_type') != 'relu':
+            continue
+        next_conv = consumers[id(act)][0][0] if len(consumers[id(act)]) == 1 else None
+        if (next_conv is None or next_conv['op'] != 'Convolution'
+                or int(next_conv['attrs'].get('num_group', 1)) != 1):
+            continue
+        weight = conv['inputs'][1][0]['name']
+        next_weight = next_conv['inputs'][1][0]['name']
+        if weight not in arg_params or next_weight not in arg_params:
+            continue
+        w = arg_params[weight]
+        keep = max(1, int(round(w.shape[0] * (1.0 - ratio))))
+        norms = np.abs(w).reshape((w.shape[0], -1)).sum(axis=1)
+        index = np.sort(np.argsort(norms)[-keep:])
+        arg_params[weight] = w[index]
+        if len(conv['inputs']) > 2:
+            bias = conv['inputs'][2][0]['name']
+            arg_params[bias] = arg_params[bias][index]
+        arg_params[next_weight] = arg_params[next_weight][:, index]
+        conv['attrs']['num_filter'] = str(keep)
+        pruned += 1
+    print('pruned %d convolutions to %.0f%% of their filters' % (pruned, 100 * (1.0 - ratio)))
+    return _to_graph(graph, heads), arg_params, aux_params
+
+
+def load_block(prefix, ctx):
+    return gluon.SymbolBlock.imports('%s-symbol.json' % prefix, ['data'], '%s-0000.params' % prefix, ctx=ctx)
+
+
+def measure_cpu_latency(prefix, num_frames, iters=10, input_size=224):
+    """Median latency in ms of one clip on the CPU."""
+    block = load_block(prefix, mx.cpu())
+    clip = nd.random.uniform(shape=(1, 3, num_frames, input_size, input_size))
+    block(clip).wait_to_read()
+    times = []
+    for _ in range(iters):
+        tic = time.time()
+        block(clip).wait_to_read()
+        times.append(1000 * (time.time() - tic))
+    return float(np.median(times))
+
+
+def export_variants(model_dir, ctx, clip_lengths=(8, 16, 32), prune_ratio=0.0,
+                    evaluate_fn=None, latency_iters=10, accuracy_tolerance=0.01, train_frames=32):
+    """Write the fused (and pruned) variants next to `model` and a manifest describing all of them.
+
+    `evaluate_fn(block, num_frames)` returns the validation accuracy of a block at a
+    clip length, or None when no validation data is available. The manifest's
+    default is the fastest variant within `accuracy_tolerance` of the best accuracy.
+    Without accuracies it is the fused variant at the `train_frames` clip length the
+    model was trained at, since the shorter clips and pruning can lose accuracy.
+    """
+    clip_lengths = sorted(set(clip_lengths) | set([train_frames]))
+    base = os.path.join(model_dir, 'model')
+    graph, arg_params, aux_params = load_exported(base)
+    prefixes = [('base', base)]
+
+    graph, arg_params, aux_params = fold_batchnorm(graph, arg_params, aux_params)
+    save_exported(base + '-fused', graph, arg_params, aux_params)
+    prefixes.append(('fused', base + '-fused'))
+
+    if prune_ratio > 0:
+        graph, arg_params, aux_params = prune_channels(graph, arg_params, aux_params, prune_ratio)
+        save_exported(base + '-pruned', graph, arg_params, aux_params)
+        prefixes.append(('pruned', base + '-pruned'))
+
+    variants = []
+    for kind, prefix in prefixes:
+        block = load_block(prefix, ctx) if evaluate_fn else None
+        for num_frames in clip_lengths:
+            accuracy = evaluate_fn(block, num_frames) if evaluate_fn else None
+            latency = measure_cpu_latency(prefix, num_frames, iters=latency_iters)
+            variant = {
+                'name': '%s-%d' % (kind, num_frames),
+                'prefix': os.path.basename(prefix),
+                'num_frames': num_frames,
+                'accuracy': accuracy,
+                'cpu_latency_ms': latency,
+            }
+            print('[Export] %s' % json.dumps(variant))
+            variants.append(variant)
+
+    accuracies = [v['accuracy'] for v in variants if v['accuracy'] is not None]
+    if accuracies:
+        candidates = [v for v in variants if v['accuracy'] is not None
+                      and v['accuracy'] >= max(accuracies) - accuracy_tolerance]
+        default = min(candidates, key=lambda v: v['cpu_latency_ms'])
+    else:
+        default = [v for v in variants if v['name'] == 'fused-%d' % train_frames][0]
+    with open(os.path.join(model_dir, MANIFEST_NAME), 'w') as fopen:
+        json.dump({'default': default['name'], 'variants': variants}, fopen, indent=2)
+    print('[Export] default variant: %s' % default['name'])
+    return variants
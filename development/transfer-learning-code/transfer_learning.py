@@ -4,23 +4,40 @@
 from __future__ import print_function
 
 import argparse
+import hashlib
 import logging
 import os
 import numpy as np
 import json
 import time
+import random
+import pickle
+import shutil
+import tempfile
+import threading
+from itertools import islice
+from collections import OrderedDict, deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import mxnet as mx
-from mxnet import gluon
+from mxnet import gluon, nd
 from mxnet.gluon import nn
 from mxnet import autograd as ag
 from mxnet.gluon.data.vision import transforms
+from mxnet.contrib import amp
 
 import gluoncv as gcv
 from gluoncv.data.transforms import video
 from gluoncv.data import VideoClsCustom
 from gluoncv.model_zoo import get_model
 from gluoncv.utils import makedirs, LRSequential, LRScheduler, split_and_load, TrainingHistory
+from gluoncv.utils.filesystem import try_import_decord
+
+from model_export import export_variants
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -49,6 +66,15 @@ def train(args):
     #after each update, the weights are multiplied by a factor slightly less than 1.
     wd = args.wd
     optimizer_params = {'learning_rate': learning_rate, 'wd': wd, 'momentum': momentum}
+    #automatic mixed precision computes in float16 and scales the loss dynamically,
+    #the weights and the optimizer stay in float32
+    use_amp = args.dtype == 'float16' and not args.multi_precision
+    #multi-precision casts the network to float16 and the SGD update keeps float32 master weights,
+    #the loss is scaled by a static factor so the float16 gradients do not underflow
+    cast_fp16 = args.dtype == 'float16' and args.multi_precision
+    loss_scale = args.loss_scale if cast_fp16 else 1.0
+    if cast_fp16:
+        optimizer_params['multi_precision'] = True
     log_interval = args.log_interval
     
     #In this example, we use Inflated 3D model (I3D) with ResNet50 backbone trained on Kinetics400 dataset. We want to replace the last classification (dense) layer to the number of classes in the dataset. 
@@ -56,88 +82,374 @@ def train(args):
     #number of classes in the dataset
     nclass = 101
     #number of workers for the data loader
-    num_workers = 8
+    num_workers = args.num_workers
     
     current_host = args.current_host
     hosts = args.hosts
     model_dir = args.model_dir
+    #with more than one host, gradients are aggregated across hosts through the parameter server
+    kvstore = args.kvstore
+    if kvstore == 'auto':
+        kvstore = 'dist_sync' if len(hosts) > 1 else 'device'
+    kv = mx.kv.create(kvstore)
+    rank = kv.rank
+    num_hosts = kv.num_workers
+    print('%s: worker %d of %d, kvstore %s' % (current_host, rank, num_hosts, kvstore))
     CHECKPOINTS_DIR = '/opt/ml/checkpoints'
     checkpoints_enabled = os.path.exists(CHECKPOINTS_DIR)
 
     data_dir = args.train
-    segments = 'rawframes'
-    train ='ucfTrainTestlist/ucf101_train_split_2_rawframes.txt'
+    data_format = args.data_format
+    #rawframes are the extracted jpgs, videos are decoded on the fly from the source files
+    segments = 'rawframes' if data_format == 'rawframes' else args.video_root
+    train ='ucfTrainTestlist/ucf101_train_split_2_%s.txt' % data_format
+    val ='ucfTrainTestlist/ucf101_val_split_2_%s.txt' % data_format
     
     #load the data with data loader
-    train_data = load_data(data_dir,batch_size,num_workers,segments,train)
+    train_data, train_sampler = load_data(data_dir,batch_size,num_workers,segments,train,data_format=data_format,
+                           video_ext=args.video_ext,reader_cache_size=args.reader_cache_size,
+                           clip_cache_dir=args.clip_cache_dir,clip_cache_size_gb=args.clip_cache_size_gb,
+                           num_shards=num_hosts,shard_index=rank,prefetch=args.prefetch,
+                           pin_memory=args.pin_memory and num_gpus > 0,seed=args.seed)
+    #every host evaluates the whole split so they all take the same early stopping decision
+    val_data = None
+    if args.val_interval > 0:
+        val_data = load_val_data(data_dir,batch_size,num_workers,segments,val,data_format=data_format,
+                                 video_ext=args.video_ext,reader_cache_size=args.reader_cache_size)
+    mode = 'float16 multi-precision' if cast_fp16 else args.dtype
+    if args.benchmark_iters > 0 and args.dtype != 'float32':
+        #measure the float32 baseline before AMP patches the operators
+        fp32_params = dict(optimizer_params, multi_precision=False)
+        fp32_speed = benchmark_throughput(ctx, model_name, nclass, batch_size, optimizer,
+                                          fp32_params, args.benchmark_iters, use_amp=False)
+    if use_amp:
+        amp.init(target_dtype=args.dtype)
+    if args.benchmark_iters > 0:
+        speed = benchmark_throughput(ctx, model_name, nclass, batch_size, optimizer,
+                                     optimizer_params, args.benchmark_iters, use_amp=use_amp,
+                                     cast_fp16=cast_fp16, loss_scale=loss_scale)
+        print('[Benchmark] %s: %.2f clips/sec' % (mode, speed))
+        if args.dtype != 'float32':
+            print('[Benchmark] float32: %.2f clips/sec, %s speed-up: %.2fx' %
+                  (fp32_speed, mode, speed / fp32_speed))
     # define the network
     net = define_network(ctx,model_name,nclass)
-    #define the gluon trainer
-    trainer = gluon.Trainer(net.collect_params(), optimizer, optimizer_params)
+    if cast_fp16:
+        #BatchNorm keeps its parameters in float32
+        net.cast('float16')
+    #define the gluon trainer, the kvstore keeps the hosts in sync. The AMP loss scale is
+    #applied by the trainer and the trainer states can only be saved and loaded when the
+    #optimizer runs in this process, so with either the update runs locally and not on the kvstore
+    trainer = gluon.Trainer(net.collect_params(), optimizer, optimizer_params, kvstore=kv,
+                            update_on_kvstore=False if use_amp or 'dist' in kvstore else None)
+    if use_amp:
+        amp.init_trainer(trainer)
     #define loss function
     loss_fn = gluon.loss.SoftmaxCrossEntropyLoss()
     #define training metric
     train_metric = mx.metric.Accuracy()
-    train_history = TrainingHistory(['training-acc'])
+    train_history = TrainingHistory(['training-acc', 'validation-acc'])
     net.hybridize()
     #learning rate decay hyperparameters
     lr_decay_count = 0
     lr_decay = 0.1
     lr_decay_epoch = [40, 80, 100]
-    for epoch in range(epochs):
+    #early stopping on a plateau of the validation accuracy
+    best_val_acc = 0.0
+    num_bad_evals = 0
+    #set once this run (or the run it resumes) has saved the best parameters, a file left
+    #behind by an earlier job is never restored
+    has_best = False
+    best_params = os.path.join(CHECKPOINTS_DIR if checkpoints_enabled else tempfile.mkdtemp(), 'best-model.params')
+
+    #resume from the latest checkpoint if the job was interrupted (e.g. managed spot training)
+    start_epoch, start_iter = 0, 0
+    checkpointer = None
+    if checkpoints_enabled:
+        checkpointer = AsyncCheckpointer(CHECKPOINTS_DIR, keep=args.keep_checkpoints)
+        state = checkpointer.load_latest(net, trainer)
+        if state is not None:
+            start_epoch, start_iter = state['epoch'], state['iteration']
+            lr_decay_count = state['lr_decay_count']
+            best_val_acc = state.get('best_val_acc', 0.0)
+            num_bad_evals = state.get('num_bad_evals', 0)
+            has_best = state.get('has_best', False)
+            trainer.set_learning_rate(state['learning_rate'])
+            print('Resuming from epoch %d iteration %d' % (start_epoch, start_iter))
+
+    def checkpoint_state(epoch, iteration):
+        return {'epoch': epoch, 'iteration': iteration, 'lr_decay_count': lr_decay_count,
+                'learning_rate': trainer.learning_rate, 'best_val_acc': best_val_acc,
+                'num_bad_evals': num_bad_evals, 'has_best': has_best}
+
+    for epoch in range(start_epoch, epochs):
         tic = time.time()
         train_metric.reset()
         train_loss = 0
+        #reseed per epoch, the python and numpy generators are restored from the checkpoint
+        mx.random.seed(args.seed + epoch)
 
         # Learning rate decay
-        if epoch == lr_decay_epoch[lr_decay_count]:
+        if lr_decay_count < len(lr_decay_epoch) and epoch == lr_decay_epoch[lr_decay_count]:
             trainer.set_learning_rate(trainer.learning_rate*lr_decay)
             lr_decay_count += 1
 
-        # Loop through each batch of training data
-        for i, batch in enumerate(train_data):
-            # Extract data and label
-            data = split_and_load(batch[0], ctx_list=ctx, batch_axis=0,even_split=False)
-            label = split_and_load(batch[1], ctx_list=ctx, batch_axis=0,even_split=False)
+        # Loop through each batch of training data. The shuffle order only depends on the epoch,
+        # so after a resume the rest of the epoch is the batches that had not been seen yet
+        train_sampler.set_epoch(epoch, start_iter * batch_size)
+        #the copy of the next batch to the devices overlaps with the current step
+        batches = DevicePrefetcher(train_data, ctx, depth=args.device_prefetch)
+        i = start_iter - 1
+        wait_time, step_time, step_tic = 0.0, 0.0, time.time()
+        for i, (data, label) in enumerate(batches, start_iter):
+            wait_time += batches.wait_time
 
             # AutoGrad
             with ag.record():
                 output = []
                 for _, X in enumerate(data):
                     X = X.reshape((-1,) + X.shape[2:])
-                    pred = net(X)
+                    if cast_fp16:
+                        #the loss is computed in float32 on the float16 network's output
+                        pred = net(X.astype('float16')).astype('float32')
+                    else:
+                        pred = net(X)
                     output.append(pred)
                 loss = [loss_fn(yhat, y) for yhat, y in zip(output, label)]
 
-            # Backpropagation
-            for l in loss:
-                l.backward()
+                # Backpropagation
+                if use_amp:
+                    with amp.scale_loss(loss, trainer) as scaled_loss:
+                        ag.backward(scaled_loss)
+                else:
+                    for l in loss:
+                        (l * loss_scale).backward()
 
-            # Optimize
-            trainer.step(batch_size)
+            # Optimize, gradients are summed over the batches of all hosts and unscaled
+            trainer.step(batch_size * num_hosts * loss_scale)
 
             # Update metrics
             train_loss += sum([l.mean().asscalar() for l in loss])
             train_metric.update(label, output)
 
-            if i == 100:
+            step_time += time.time() - step_tic
+            step_tic = time.time()
+            if log_interval and (i + 1) % log_interval == 0:
+                #a large data wait share means training is input-bound
+                print('[Epoch %d] [Batch %d] %.2f clips/sec, data wait: %.1f ms/iter, compute: %.1f ms/iter, input-bound: %.1f%%' %
+                      (epoch, i + 1, log_interval * batch_size / step_time, 1000 * wait_time / log_interval,
+                       1000 * (step_time - wait_time) / log_interval, 100 * wait_time / step_time))
+                wait_time, step_time = 0.0, 0.0
+
+            if checkpointer and rank == 0 and args.checkpoint_interval > 0 and (i + 1) % args.checkpoint_interval == 0:
+                checkpointer.save(net, trainer, checkpoint_state(epoch, i + 1))
+
+            if args.max_iters_per_epoch and i + 1 >= args.max_iters_per_epoch:
                 break
 
         name, acc = train_metric.get()
+        epoch_time = time.time()-tic
+        num_batches = max(i + 1 - start_iter, 1)
+        print('[Epoch %d] [Worker %d] train=%f loss=%f time: %f clips/sec: %.2f (%s)' %
+            (epoch, rank, acc, train_loss / num_batches, epoch_time, num_batches * batch_size / epoch_time, args.dtype))
+        start_iter = 0
+
+        # Evaluate on the validation split
+        val_acc = float('nan')
+        stop = False
+        if val_data is not None and (epoch + 1) % args.val_interval == 0:
+            val_tic = time.time()
+            val_acc = evaluate(net, val_data, ctx, dtype='float16' if cast_fp16 else 'float32')
+            print('[Epoch %d] validation=%f time: %f' % (epoch, val_acc, time.time()-val_tic))
+            if val_acc > best_val_acc + args.early_stopping_min_delta:
+                best_val_acc = val_acc
+                num_bad_evals = 0
+                has_best = True
+                if rank == 0:
+                    net.save_parameters(best_params)
+            else:
+                num_bad_evals += 1
+                stop = args.early_stopping_patience > 0 and num_bad_evals >= args.early_stopping_patience
+
+        # Update history
+        train_history.update([acc, val_acc])
+
+        if checkpointer and rank == 0:
+            checkpointer.save(net, trainer, checkpoint_state(epoch + 1, 0))
+
+        if stop:
+            print('Stopping early, validation accuracy has not improved for %d evaluations (best %f)' %
+                  (num_bad_evals, best_val_acc))
+            break
+
+    if checkpointer:
+        checkpointer.close()
+
+    #all hosts hold the same parameters, only the first one exports the model
+    if rank == 0:
+        if has_best and os.path.exists(best_params):
+            print('restoring the parameters with the best validation accuracy %f' % best_val_acc)
+            net.load_parameters(best_params, ctx=ctx)
+        if cast_fp16:
+            #the endpoint feeds float32 clips, export a float32 model
+            net.cast('float32')
+        print('saving the model')
+        save(net, model_dir)
+        save_classes(data_dir, model_dir)
+        if args.export_variants:
+            #re-evaluate the serving variants at shorter clip lengths on the validation split
+            #the model is trained on 32 frame clips, that length is always exported
+            clip_lengths = sorted(set([int(x) for x in args.export_clip_lengths.split(',')] + [32]))
+            val_loaders = {}
+            if os.path.exists(os.path.join(data_dir, val)):
+                for num_frames in clip_lengths:
+                    val_loaders[num_frames] = load_val_data(data_dir,batch_size,num_workers,segments,val,
+                                                            data_format=data_format,video_ext=args.video_ext,
+                                                            reader_cache_size=args.reader_cache_size,
+                                                            new_length=num_frames)
+            evaluate_fn = None
+            if val_loaders:
+                evaluate_fn = lambda block, num_frames: evaluate(block, val_loaders[num_frames], ctx)
+            export_variants(model_dir, ctx, clip_lengths=clip_lengths, prune_ratio=args.prune_ratio,
+                            evaluate_fn=evaluate_fn, train_frames=32)
+     
+class AsyncCheckpointer(object):
+    """Write training checkpoints from a background thread and restore the latest one.
+
+    The parameters are copied to host memory and the trainer states are dumped on
+    the training thread, everything else (params.npz, state.json, the RNG state
+    and pruning old checkpoints) happens in the background. A checkpoint directory
+    only gets its final name once it is complete.
+    """
+    def __init__(self, checkpoint_dir, keep=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        makedirs(checkpoint_dir)
+        #one checkpoint in flight at most, a second save waits for the first
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _checkpoints(self):
+        names = [name for name in os.listdir(self.checkpoint_dir) if name.startswith('checkpoint-')]
+        return sorted(names)
+
+    def save(self, net, trainer, state):
+        name = 'checkpoint-%04d-%06d' % (state['epoch'], state['iteration'])
+        staging = os.path.join(self.checkpoint_dir, '.' + name)
+        shutil.rmtree(staging, ignore_errors=True)
+        makedirs(staging)
+        trainer.save_states(os.path.join(staging, 'trainer.states'))
+        params = [param.list_data()[0].asnumpy() for param in net.collect_params().values()]
+        rng_state = {'python': random.getstate(), 'numpy': np.random.get_state()}
+        self._queue.put((name, staging, params, dict(state), rng_state))
+
+    def _run(self):
+        while True:
+            name, staging, params, state, rng_state = self._queue.get()
+            try:
+                np.savez(os.path.join(staging, 'params.npz'), *params)
+                with open(os.path.join(staging, 'rng.pkl'), 'wb') as fopen:
+                    pickle.dump(rng_state, fopen)
+                with open(os.path.join(staging, 'state.json'), 'w') as fopen:
+                    json.dump(state, fopen)
+                final = os.path.join(self.checkpoint_dir, name)
+                shutil.rmtree(final, ignore_errors=True)
+                os.rename(staging, final)
+                for old in self._checkpoints()[:-self.keep]:
+                    shutil.rmtree(os.path.join(self.checkpoint_dir, old), ignore_errors=True)
+                print('checkpoint saved to %s' % final)
+            except Exception as e:
+                logging.exception('failed to write checkpoint %s: %s', name, e)
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        #wait for pending checkpoints to be written
+        self._queue.join()
+
+    def load_latest(self, net, trainer):
+        checkpoints = self._checkpoints()
+        if not checkpoints:
+            return None
+        path = os.path.join(self.checkpoint_dir, checkpoints[-1])
+        with open(os.path.join(path, 'state.json')) as fopen:
+            state = json.load(fopen)
+        saved = np.load(os.path.join(path, 'params.npz'))
+        for j, param in enumerate(net.collect_params().values()):
+            param.set_data(nd.array(saved['arr_%d' % j], dtype=param.dtype))
+        trainer.load_states(os.path.join(path, 'trainer.states'))
+        with open(os.path.join(path, 'rng.pkl'), 'rb') as fopen:
+            rng_state = pickle.load(fopen)
+        random.setstate(rng_state['python'])
+        np.random.set_state(rng_state['numpy'])
+        print('loaded checkpoint %s' % path)
+        return state
+
+
+def evaluate(net, val_data, ctx, dtype='float32'):
+    #top-1 accuracy over the validation loader, dtype is the input type of the network
+    val_metric = mx.metric.Accuracy()
+    for batch in val_data:
+        data = split_and_load(batch[0], ctx_list=ctx, batch_axis=0, even_split=False)
+        label = split_and_load(batch[1], ctx_list=ctx, batch_axis=0, even_split=False)
+        output = [net(X.reshape((-1,) + X.shape[2:]).astype(dtype)) for X in data]
+        val_metric.update(label, output)
+    return val_metric.get()[1]
+
+
+def benchmark_throughput(ctx, model_name, nclass, batch_size, optimizer, optimizer_params, iters, use_amp,
+                         cast_fp16=False, loss_scale=1.0):
+    #train a throwaway copy of the network on random clips and return clips/sec
+    net = define_network(ctx,model_name,nclass)
+    dtype = 'float16' if cast_fp16 else 'float32'
+    net.cast(dtype)
+    net.hybridize()
+    trainer = gluon.Trainer(net.collect_params(), optimizer, optimizer_params,
+                            update_on_kvstore=False if use_amp else None)
+    if use_amp:
+        amp.init_trainer(trainer)
+    loss_fn = gluon.loss.SoftmaxCrossEntropyLoss()
+    data = split_and_load(nd.random.uniform(shape=(batch_size, 3, 32, 224, 224), dtype=dtype),
+                          ctx_list=ctx, batch_axis=0, even_split=False)
+    label = split_and_load(nd.zeros((batch_size,)), ctx_list=ctx, batch_axis=0, even_split=False)
+    #the first iterations include graph construction and memory allocation
+    warmup = 2
+    for i in range(warmup + iters):
+        if i == warmup:
+            nd.waitall()
+            tic = time.time()
+        with ag.record():
+            loss = [loss_fn(net(X).astype('float32'), y) for X, y in zip(data, label)]
+            if use_amp:
+                with amp.scale_loss(loss, trainer) as scaled_loss:
+                    ag.backward(scaled_loss)
+            else:
+                for l in loss:
+                    (l * loss_scale).backward()
+        trainer.step(batch_size * loss_scale)
+    nd.waitall()
+    return iters * batch_size / (time.time() - tic)
 
-        # Update history and print metrics
-        train_history.update([acc])
-        print('[Epoch %d] train=%f loss=%f time: %f' %
-            (epoch, acc, train_loss / (i+1), time.time()-tic))
 
-    print('saving the model')
-    save(net, model_dir)
-     
 def save(net, model_dir):
     # save the model
     net.export('%s/model'% model_dir)
 
 
+def save_classes(data_dir, model_dir):
+    # the class names in label order, read by the inference code from classes.txt
+    class_ind = os.path.join(data_dir, 'ucfTrainTestlist', 'classInd.txt')
+    if not os.path.exists(class_ind):
+        print('no %s, not writing classes.txt' % class_ind)
+        return
+    with open(class_ind) as fopen:
+        classes = [line.split()[1] for line in fopen if line.strip()]
+    with open(os.path.join(model_dir, 'classes.txt'), 'w') as fopen:
+        fopen.write('\n'.join(classes) + '\n')
+
+
 def define_network(ctx,model_name,nclass):
     #In GluonCV, we can get a customized model with one line of code.
     net = get_model(name=model_name, nclass=nclass)
@@ -146,7 +458,265 @@ def define_network(ctx,model_name,nclass):
     return net
 
 
-def load_data(data_dir, batch_size,num_workers,segments,train):
+class VideoClipDataset(gluon.data.Dataset):
+    """Decode training clips straight from the source videos with decord.
+
+    Reads the `--format videos` lists written by ucf101.py (`<video> <label>`, or
+    `<video> <duration> <label>`). Each data loader worker keeps its own small LRU
+    cache of open readers and fetches all frames of a clip in one `get_batch` call.
+    """
+    def __init__(self, root, setting, train=True, new_length=32, new_width=340, new_height=256,
+                 video_ext='avi', reader_cache_size=8, transform=None):
+        super(VideoClipDataset, self).__init__()
+        self.root = root
+        self.train = train
+        self.new_length = new_length
+        self.new_width = new_width
+        self.new_height = new_height
+        self.video_ext = video_ext
+        self.reader_cache_size = reader_cache_size
+        self.transform = transform
+        self.clips = []
+        with open(setting) as fopen:
+            for line in fopen:
+                items = line.split()
+                if not items:
+                    continue
+                self.clips.append((items[0], int(items[-1])))
+        #filled lazily, so every forked data loader worker ends up with its own readers
+        self._readers = OrderedDict()
+        self._reader_pid = None
+
+    def __len__(self):
+        return len(self.clips)
+
+    def _get_reader(self, path):
+        if self._reader_pid != os.getpid():
+            self._readers = OrderedDict()
+            self._reader_pid = os.getpid()
+        reader = self._readers.pop(path, None)
+        if reader is None:
+            reader = try_import_decord().VideoReader(path, width=self.new_width, height=self.new_height)
+            if len(self._readers) >= self.reader_cache_size:
+                self._readers.popitem(last=False)
+        self._readers[path] = reader
+        return reader
+
+    def load_frames(self, index):
+        name, label = self.clips[index]
+        path = os.path.join(self.root, '%s.%s' % (name, self.video_ext))
+        reader = self._get_reader(path)
+        duration = len(reader)
+        #random temporal offset for training, centered for validation, looping short videos to fill the clip
+        if self.train:
+            offset = random.randint(0, max(duration - self.new_length, 0))
+        else:
+            offset = max(duration - self.new_length, 0) // 2
+        indices = [(offset + i) % duration for i in range(self.new_length)]
+        frames = reader.get_batch(indices).asnumpy()
+        return [frame for frame in frames], label
+
+    def __getitem__(self, index):
+        clip_input, label = self.load_frames(index)
+        return clip_to_input(clip_input, self.transform, self.new_length), label
+
+
+class RawFrameClsCustom(VideoClsCustom):
+    """VideoClsCustom that can also hand out the decoded frames before augmentation."""
+    def load_frames(self, index):
+        directory, duration, target = self.clips[index]
+        segment_indices, skip_offsets = self._sample_train_indices(duration)
+        clip_input = self._image_TSN_cv2_loader(directory, duration, segment_indices, skip_offsets)
+        return clip_input, target
+
+
+class ClipCache(object):
+    """On-disk cache of decoded uint8 clips, one memory-mappable .npy file per sample.
+
+    Files are written atomically, so all data loader workers can share the same
+    directory. Each worker keeps a running count of the cache size and reads the
+    real size, which includes the clips of the other workers, from the directory
+    every `rescan_every` writes and whenever its count reaches `max_bytes`. When
+    the cache is over `max_bytes` the least recently used clips are evicted down
+    to 90% of the limit. Between rescans the cache can overshoot by up to
+    `rescan_every` clips per worker.
+    """
+    def __init__(self, cache_dir, max_bytes, rescan_every=64):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.rescan_every = rescan_every
+        makedirs(cache_dir)
+        self._bytes = self._scan()[0]
+        self._writes = 0
+
+    def _path(self, index):
+        return os.path.join(self.cache_dir, 'clip_%08d.npy' % index)
+
+    def _scan(self):
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, fname))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        return sum(e[1] for e in entries), entries
+
+    def get(self, index):
+        path = self._path(index)
+        try:
+            clip = np.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+        #mark as recently used for eviction
+        os.utime(path, None)
+        return clip
+
+    def put(self, index, clip):
+        if clip.nbytes > self.max_bytes:
+            return
+        self._writes += 1
+        if self._bytes + clip.nbytes > self.max_bytes or self._writes % self.rescan_every == 0:
+            #rescan, the other workers have been filling the same directory
+            self._bytes, entries = self._scan()
+            if self._bytes + clip.nbytes > self.max_bytes:
+                self._evict(entries, self.max_bytes * 0.9 - clip.nbytes)
+        tmp_path = '%s.%d.tmp' % (self._path(index), os.getpid())
+        with open(tmp_path, 'wb') as fopen:
+            np.save(fopen, clip)
+        os.rename(tmp_path, self._path(index))
+        self._bytes += clip.nbytes
+
+    def _evict(self, entries, target_bytes):
+        for _, size, fname in sorted(entries):
+            if self._bytes <= target_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except OSError:
+                continue
+            self._bytes -= size
+
+
+class CachedClipDataset(gluon.data.Dataset):
+    """Decode each clip once and reuse it in later epochs.
+
+    The first epoch decodes through `dataset.load_frames` and stores the resized
+    uint8 frames in a ClipCache. Later epochs read them back memory-mapped and
+    only run the random crop/flip transform. The temporal window of a clip is
+    therefore fixed after it has been cached.
+    """
+    def __init__(self, dataset, cache, transform=None, new_length=32):
+        super(CachedClipDataset, self).__init__()
+        self.dataset = dataset
+        self.cache = cache
+        self.transform = transform
+        self.new_length = new_length
+        self.labels = [clip[-1] for clip in dataset.clips]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        clip = self.cache.get(index)
+        if clip is None:
+            frames, _ = self.dataset.load_frames(index)
+            clip = np.stack(frames, axis=0).astype(np.uint8)
+            self.cache.put(index, clip)
+        clip_input = [clip[i] for i in range(clip.shape[0])]
+        return clip_to_input(clip_input, self.transform, self.new_length), self.labels[index]
+
+
+def clip_to_input(clip_input, transform, new_length, input_size=224):
+    #transform a list of HWC frames and lay the clip out as (1, channels, frames, height, width)
+    if transform is not None:
+        clip_input = transform(clip_input)
+    clip_input = np.stack(clip_input, axis=0)
+    clip_input = clip_input.reshape((-1,) + (new_length, 3, input_size, input_size))
+    clip_input = np.transpose(clip_input, (0, 2, 1, 3, 4))
+    return nd.array(clip_input)
+
+
+class DevicePrefetcher(object):
+    """Copy the next `depth` batches to the devices ahead of the training step.
+
+    `split_and_load` only queues the host-to-device copies on the MXNet engine, so
+    issuing them before the current step runs lets the copy overlap with compute.
+    `wait_time` is how long the last batch took to come out of the data loader.
+    """
+    def __init__(self, batches, ctx, depth=1):
+        self.batches = batches
+        self.ctx = ctx
+        self.depth = max(depth, 1)
+        self.wait_time = 0.0
+
+    def _load(self, batch):
+        data = split_and_load(batch[0], ctx_list=self.ctx, batch_axis=0, even_split=False)
+        label = split_and_load(batch[1], ctx_list=self.ctx, batch_axis=0, even_split=False)
+        return data, label
+
+    def __iter__(self):
+        it = iter(self.batches)
+        pending = deque()
+        tic = time.time()
+        for batch in islice(it, self.depth):
+            pending.append(self._load(batch))
+        while pending:
+            current = pending.popleft()
+            for batch in islice(it, 1):
+                pending.append(self._load(batch))
+            self.wait_time = time.time() - tic
+            yield current
+            tic = time.time()
+
+
+class ShardedDataset(gluon.data.Dataset):
+    """Every `num_shards`-th sample starting at `index`, so each host trains on its own part.
+
+    All shards have the same length, the shorter ones wrap around to the start of
+    the dataset, so every host runs the same number of dist_sync steps per epoch.
+    """
+    def __init__(self, dataset, num_shards, index):
+        super(ShardedDataset, self).__init__()
+        self.dataset = dataset
+        shard_len = (len(dataset) + num_shards - 1) // num_shards
+        self.indices = [(index + i * num_shards) % len(dataset) for i in range(shard_len)]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.dataset[self.indices[index]]
+
+
+class EpochSampler(gluon.data.Sampler):
+    """Shuffle the samples in an order that only depends on the seed and the epoch.
+
+    `set_epoch(epoch, start)` selects the order of an epoch and skips its first
+    `start` samples, so an epoch resumed from a checkpoint sees the same batches.
+    """
+    def __init__(self, length, seed=0):
+        self._length = length
+        self._seed = seed
+        self._epoch = 0
+        self._start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self._epoch = epoch
+        self._start = min(start, self._length)
+
+    def __iter__(self):
+        indices = np.random.RandomState(self._seed + self._epoch).permutation(self._length)
+        return iter(indices[self._start:].tolist())
+
+    def __len__(self):
+        return self._length - self._start
+
+
+def load_data(data_dir, batch_size,num_workers,segments,train,data_format='rawframes',
+              video_ext='avi',reader_cache_size=8,clip_cache_dir=None,clip_cache_size_gb=50,
+              num_shards=1,shard_index=0,prefetch=None,pin_memory=False,seed=0):
 
     #The transformation function does three things: center crop the image to 224x224 in size, transpose it to num_channels,num_frames,height*width, and normalize with mean and standard deviation calculated across all ImageNet images.
 
@@ -154,12 +724,50 @@ def load_data(data_dir, batch_size,num_workers,segments,train):
     
     transform_train = video.VideoGroupTrainTransform(size=(224, 224), scale_ratios=[1.0, 0.8], mean=[0.485, 0.456, 0.406], 
                                                           std=[0.229, 0.224, 0.225])
-    train_dataset = VideoClsCustom(root=data_dir + '/' + 
-                                   segments,setting=data_dir + '/' + train,train=True,new_length=32,transform=transform_train)
+    if data_format == 'videos':
+        #Skip the frame dump entirely and decode clips from the videos with decord
+        train_dataset = VideoClipDataset(root=data_dir + '/' + segments,setting=data_dir + '/' + train,
+                                         new_length=32,video_ext=video_ext,reader_cache_size=reader_cache_size,
+                                         transform=transform_train)
+    else:
+        train_dataset = RawFrameClsCustom(root=data_dir + '/' + 
+                                          segments,setting=data_dir + '/' + train,train=True,new_length=32,transform=transform_train)
+    if clip_cache_dir:
+        #Decode every clip once, later epochs only pay for the random crop and flip. Clips are
+        #cached by their index in the list, a list with other contents gets its own directory
+        with open(data_dir + '/' + train, 'rb') as fopen:
+            list_hash = hashlib.md5(fopen.read()).hexdigest()[:12]
+        cache = ClipCache(os.path.join(clip_cache_dir, '%s-%s' % (os.path.splitext(os.path.basename(train))[0], list_hash)),
+                          int(clip_cache_size_gb * 1024 ** 3))
+        train_dataset = CachedClipDataset(train_dataset, cache, transform=transform_train, new_length=32)
+    if num_shards > 1:
+        train_dataset = ShardedDataset(train_dataset, num_shards, shard_index)
     print(os.listdir(data_dir+ '/' + segments))
     print('Load %d training samples.' % len(train_dataset))
-    return gluon.data.DataLoader(train_dataset, batch_size=batch_size,
-                                                   shuffle=True, num_workers=num_workers)
+    sampler = EpochSampler(len(train_dataset), seed)
+    #pinned host buffers make the copies to the GPUs faster and let them run asynchronously
+    loader = gluon.data.DataLoader(train_dataset, batch_size=batch_size,
+                                   sampler=sampler, num_workers=num_workers,
+                                   prefetch=prefetch, pin_memory=pin_memory)
+    return loader, sampler
+
+
+def load_val_data(data_dir, batch_size,num_workers,segments,val,data_format='rawframes',
+                  video_ext='avi',reader_cache_size=8,new_length=32):
+
+    #Validation clips are center cropped and sampled from the middle of the video
+    transform_val = video.VideoGroupValTransform(size=224, mean=[0.485, 0.456, 0.406],
+                                                 std=[0.229, 0.224, 0.225])
+    if data_format == 'videos':
+        val_dataset = VideoClipDataset(root=data_dir + '/' + segments,setting=data_dir + '/' + val,train=False,
+                                       new_length=new_length,video_ext=video_ext,reader_cache_size=reader_cache_size,
+                                       transform=transform_val)
+    else:
+        val_dataset = VideoClsCustom(root=data_dir + '/' + segments,setting=data_dir + '/' + val,
+                                     train=False,new_length=new_length,transform=transform_val)
+    print('Load %d validation samples.' % len(val_dataset))
+    return gluon.data.DataLoader(val_dataset, batch_size=batch_size,
+                                 shuffle=False, num_workers=num_workers)
 
 
 
@@ -175,16 +783,57 @@ def parse_args():
     parser.add_argument('--learning-rate', type=float, default=0.001)
     parser.add_argument('--momentum', type=float, default=0.9)
     parser.add_argument('--wd', type=float, default=0.0001)
-    parser.add_argument('--log-interval', type=float, default=100)
+    parser.add_argument('--log-interval', type=int, default=100)
+    #0 trains on the whole training list every epoch
+    parser.add_argument('--max-iters-per-epoch', type=int, default=0)
+    #evaluate every n epochs, 0 disables validation
+    parser.add_argument('--val-interval', type=int, default=1)
+    #stop after n evaluations without improvement, 0 disables early stopping
+    parser.add_argument('--early-stopping-patience', type=int, default=0)
+    parser.add_argument('--early-stopping-min-delta', type=float, default=0.0)
 
     parser.add_argument('--optimizer', type=str, default='sgd')
-    parser.add_argument('--model-dir', type=str, default=os.environ['SM_MODEL_DIR'])
-    parser.add_argument('--train', type=str, default=os.environ['SM_CHANNEL_TRAINING'])
-
-    parser.add_argument('--current-host', type=str, default=os.environ['SM_CURRENT_HOST'])
-    parser.add_argument('--hosts', type=list, default=json.loads(os.environ['SM_HOSTS']))
-
-    return parser.parse_args()
+    #float16 turns on automatic mixed precision, or with --multi-precision trains a float16
+    #copy of the network with float32 master weights in the SGD update
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--multi-precision', type=lambda x: str(x).lower() in ('true', '1', 'yes'), default=False)
+    #static loss scale of the multi-precision mode
+    parser.add_argument('--loss-scale', type=float, default=128.0)
+    #train a copy of the network on random clips first and report clips/sec against float32
+    parser.add_argument('--benchmark-iters', type=int, default=0)
+    #checkpoints go to /opt/ml/checkpoints at the end of every epoch and, if set, every n iterations
+    parser.add_argument('--checkpoint-interval', type=int, default=0)
+    parser.add_argument('--keep-checkpoints', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    #serving variants written next to the model with a variants.json manifest, off by default
+    parser.add_argument('--export-variants', type=lambda x: str(x).lower() in ('true', '1', 'yes'), default=False)
+    parser.add_argument('--export-clip-lengths', type=str, default='8,16,32')
+    #fraction of the filters removed from the inner bottleneck convolutions, 0 disables pruning
+    parser.add_argument('--prune-ratio', type=float, default=0.0)
+    parser.add_argument('--model-dir', type=str, default=os.environ.get('SM_MODEL_DIR', 'model'))
+    parser.add_argument('--train', type=str, default=os.environ.get('SM_CHANNEL_TRAINING', 'datasets/ucf101'))
+    parser.add_argument('--data-format', type=str, default='rawframes', choices=['rawframes', 'videos'])
+    parser.add_argument('--video-root', type=str, default='UCF-101')
+    parser.add_argument('--video-ext', type=str, default='avi')
+    parser.add_argument('--reader-cache-size', type=int, default=8)
+    parser.add_argument('--clip-cache-dir', type=str, default='')
+    parser.add_argument('--clip-cache-size-gb', type=float, default=50)
+    #data loader workers and the number of batches they prepare ahead (defaults to 2 per worker)
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--prefetch', type=int, default=None)
+    parser.add_argument('--pin-memory', type=lambda x: str(x).lower() in ('true', '1', 'yes'), default=True)
+    #batches copied to the devices ahead of the training step
+    parser.add_argument('--device-prefetch', type=int, default=1)
+
+    parser.add_argument('--current-host', type=str, default=os.environ.get('SM_CURRENT_HOST', 'algo-1'))
+    parser.add_argument('--hosts', type=json.loads, default=json.loads(os.environ.get('SM_HOSTS', '["algo-1"]')))
+    #auto uses dist_sync on multi-host jobs, set dist_sync explicitly when launching local processes
+    parser.add_argument('--kvstore', type=str, default='auto', choices=['auto', 'device', 'local', 'dist_sync', 'dist_device_sync'])
+
+    args = parser.parse_args()
+    if args.multi_precision and args.dtype != 'float16':
+        parser.error('--multi-precision needs --dtype float16')
+    return args
 
 
 if __name__ == '__main__':